@@ -8,8 +8,24 @@ from minio import Minio
 import subprocess
 import shutil
 import time
+import re
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from email_notifier import send_email
 from encryption import EncryptionManager
+from entry_index import EntryIndex
+from stat_cache import StatCache
+from chunk_store import ChunkStore
+from pack_store import PackWriter
+from compression import CompressingReader, choose_codec, compress_bytes
+from multipart import MultipartUploader
+from journal import BackupJournal
+from catalog import Catalog
+from manifest import ManifestWriter, ChunkReader, iter_entries
+from snapshot_index import read_index, record_snapshot, list_snapshot_timestamps
+from db_incremental import database_state, plan_backup, list_sequences, table_counters, exported_snapshot
+from db_cluster import list_databases, select_databases, cluster_db_config, globals_path
 
 
 client = Minio(
@@ -20,6 +36,15 @@ client = Minio(
 )
 
 encryption_manager = None
+stat_cache = None
+compression_config = {}
+multipart_uploader = None
+journal_config = {}
+manifest_config = {}
+catalog = None
+
+MB = 1024 * 1024
+upload_part_size = 16 * MB
 
 
 def load_config(path="config.json"):
@@ -42,95 +67,200 @@ def format_size(bytes_size):
 
 def get_previous_backup_metadata(bucket: str, source_name: str):
     try:
-        objects = client.list_objects(bucket, prefix=f"{source_name}/", recursive=False)
-        timestamps = []
-        for obj in objects:
-            parts = obj.object_name.rstrip('/').split('/')
-            if len(parts) >= 2:
-                timestamp = parts[1]
-                if timestamp and timestamp not in timestamps:
-                    timestamps.append(timestamp)
-        
+        index = read_index(client, bucket, source_name)
+        if index and index.get("latest"):
+            try:
+                metadata_obj = client.get_object(bucket, f"{source_name}/{index['latest']}/metadata.json")
+                return json.loads(metadata_obj.read().decode('utf-8'))
+            except Exception as e:
+                print(f"Snapshot index for {source_name} is stale, listing snapshots: {e}")
+
+        timestamps = list_snapshot_timestamps(client, bucket, source_name)
         if not timestamps:
             return None
         
+        # Interrupted runs leave prefixes without metadata.json, fall back to
+        # the newest snapshot that was actually completed
         timestamps.sort(reverse=True)
-        latest_timestamp = timestamps[0]
-        
-        metadata_obj = client.get_object(bucket, f"{source_name}/{latest_timestamp}/metadata.json")
-        metadata = json.loads(metadata_obj.read().decode('utf-8'))
-        return metadata
+        for timestamp in timestamps:
+            try:
+                metadata_obj = client.get_object(bucket, f"{source_name}/{timestamp}/metadata.json")
+            except Exception:
+                continue
+            metadata = json.loads(metadata_obj.read().decode('utf-8'))
+            return metadata
+        print(f"No completed previous backup found for {source_name}")
+        return None
     except Exception as e:
         print(f"No previous backup found for {source_name}: {e}")
         return None
 
-def upload_file(path: Path, bucket: str, object_name: str, encrypt=False):
-    global encryption_manager
+def get_part_size(expected_size=0, preferred_size=None):
+    # S3 allows at most 10000 parts, leave some headroom for encryption overhead;
+    # the preferred size only grows when the object would need more parts
+    min_part_size = -(-int(expected_size * 1.01) // 10000)
+    part_size = max(upload_part_size if preferred_size is None else preferred_size, min_part_size, 5 * MB)
+    return -(-part_size // MB) * MB
+
+class HashingReader:
+    # Hashes data as it is read so the file only has to be read from disk once
+    
+    def __init__(self, stream):
+        self._stream = stream
+        self.sha = hashlib.sha256()
+        self.size = 0
+    
+    def readinto(self, buffer):
+        count = self._stream.readinto(buffer)
+        if count:
+            with memoryview(buffer) as view:
+                self.sha.update(view[:count])
+            self.size += count
+        return count
     
-    file_hash = sha256_file(path)
-    file_size = path.stat().st_size
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.sha.update(data)
+        self.size += len(data)
+        return data
     
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+def probe_codec(path: Path):
+    if not compression_config.get("enabled", False):
+        return None
     with path.open("rb") as f:
-        file_data = f.read()
+        probe = f.read(compression_config.get("probe_size_kb", 64) * 1024)
+    return choose_codec(path, probe, compression_config)
+
+def build_upload_stream(reader, encrypt=False, codec=None, salt=None):
+    data = reader
+    if codec:
+        data = CompressingReader(data, codec, compression_config.get("level"))
+    if encrypt and encryption_manager:
+        data = ChunkReader(encryption_manager.encrypt_stream(data, salt=salt))
+    return data
+
+def put_file_stream(path: Path, bucket: str, object_name: str, expected_size: int, encrypt=False, codec=None):
+    if multipart_uploader and expected_size >= multipart_uploader.threshold:
+        return put_file_multipart(path, bucket, object_name, expected_size, encrypt, codec)
+    
+    with path.open("rb", buffering=0) as f:
+        reader = HashingReader(f)
+        client.put_object(
+            bucket,
+            object_name,
+            data=build_upload_stream(reader, encrypt, codec),
+            length=-1,
+            part_size=get_part_size(expected_size)
+        )
+    return reader.hexdigest(), reader.size, object_name
+
+def put_file_multipart(path: Path, bucket: str, object_name: str, expected_size: int, encrypt=False, codec=None):
+    file_stat = path.stat()
+    encrypted = bool(encrypt and encryption_manager)
+    fingerprint = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, codec, compression_config.get("level")]
+    part_size = get_part_size(expected_size, multipart_uploader.part_size)
+    
+    for attempt in range(1, multipart_uploader.retries + 1):
+        # A resumed upload keeps the object name (and timestamp prefix) it was started under
+        checkpoint = multipart_uploader.begin(bucket, object_name, str(path.resolve()), fingerprint, part_size, encrypted)
+        salt = bytes.fromhex(checkpoint["salt"]) if checkpoint.get("salt") else None
+        try:
+            with path.open("rb", buffering=0) as f:
+                reader = HashingReader(f)
+                multipart_uploader.upload(checkpoint, build_upload_stream(reader, encrypt, codec, salt))
+            return reader.hexdigest(), reader.size, checkpoint["object_name"]
+        except Exception as e:
+            multipart_uploader.fail(checkpoint, e)
+            if attempt == multipart_uploader.retries:
+                raise
+            print(f"Multipart upload of {path} interrupted ({e}), retrying ({attempt + 1}/{multipart_uploader.retries})")
+
+def upload_file(path: Path, bucket: str, object_name: str, encrypt=False):
+    global encryption_manager
     
+    codec = probe_codec(path)
     if encrypt and encryption_manager:
-        encrypted_data = encryption_manager.encrypt_data(file_data)
-        data_stream = BytesIO(encrypted_data)
-        upload_size = len(encrypted_data)
         object_name = object_name + ".enc"
-        print(f"Uploaded (encrypted): {path} -> {object_name}")
+        print(f"Uploaded (encrypted{', ' + codec if codec else ''}): {path} -> {object_name}")
     else:
-        data_stream = BytesIO(file_data)
-        upload_size = file_size
-        print(f"Uploaded: {path} -> {object_name}")
+        print(f"Uploaded{' (' + codec + ')' if codec else ''}: {path} -> {object_name}")
     
-    client.put_object(bucket, object_name, data=data_stream, length=upload_size)
+    file_hash, file_size, object_name = put_file_stream(path, bucket, object_name, path.stat().st_size, encrypt, codec)
     
-    return {
+    entry = {
         "local_path": str(path),
         "object_name": object_name,
         "sha256": file_hash,
         "size": file_size,
         "encrypted": encrypt
     }
+    if codec:
+        entry["codec"] = codec
+    return entry
+
+def upload_file_incremental(path: Path, bucket: str, object_name: str, previous_entries: EntryIndex, encrypt=False, chunk_store: ChunkStore = None, pack_writer: PackWriter = None, journal: BackupJournal = None):
+    if not journal:
+        return upload_file_if_changed(path, bucket, object_name, previous_entries, encrypt, chunk_store, pack_writer)
+    
+    file_stat = path.stat()
+    journaled_entry = journal.lookup(path, file_stat)
+    if journaled_entry:
+        print(f"Skipped (done before interruption): {path}")
+        return journaled_entry
+    
+    entry = upload_file_if_changed(path, bucket, object_name, previous_entries, encrypt, chunk_store, pack_writer)
+    journal.record(entry, file_stat)
+    return entry
 
-def upload_file_incremental(path: Path, bucket: str, object_name: str, previous_metadata: dict, encrypt=False):
+def upload_file_if_changed(path: Path, bucket: str, object_name: str, previous_entries: EntryIndex, encrypt=False, chunk_store: ChunkStore = None, pack_writer: PackWriter = None):
     global encryption_manager
     
-    file_hash = sha256_file(path)
-    file_size = path.stat().st_size
-    
-    if previous_metadata:
-        for entry in previous_metadata.get("entries", []):
-            if entry.get("local_path") == str(path) and entry.get("sha256") == file_hash:
-                print(f"Skipped (unchanged): {path}")
-                return {
-                    "local_path": str(path),
-                    "object_name": entry.get("object_name"),
-                    "sha256": file_hash,
-                    "size": file_size,
-                    "skipped": True,
-                    "encrypted": entry.get("encrypted", False),
-                    "reason": "unchanged"
-                }
+    file_stat = path.stat()
+    file_size = file_stat.st_size
     
-    with path.open("rb") as f:
-        file_data = f.read()
+    # A size change already proves the file changed, so only files that kept
+    # their size need a hash (cached when the stat tuple is unchanged) before
+    # deciding to upload
+    previous_entry = previous_entries.get(path) if previous_entries else None
+    if previous_entry and previous_entry.get("size") == file_size:
+        file_hash = stat_cache.lookup(path, file_stat) if stat_cache else None
+        if file_hash is None:
+            file_hash = sha256_file(path)
+            if stat_cache:
+                stat_cache.store(path, file_stat, file_hash)
+        if previous_entry.get("sha256") == file_hash:
+            print(f"Skipped (unchanged): {path}")
+            # Keep whatever the previous entry points at (object, chunk list, ...)
+            skipped_entry = dict(previous_entry)
+            skipped_entry.update({
+                "local_path": str(path),
+                "sha256": file_hash,
+                "size": file_size,
+                "skipped": True,
+                "reason": "unchanged"
+            })
+            return skipped_entry
     
+    if pack_writer and pack_writer.accepts(file_size):
+        return upload_file_packed(path, file_stat, pack_writer)
+    if chunk_store:
+        return upload_file_chunked(path, object_name, file_stat, chunk_store)
+    
+    codec = probe_codec(path)
     if encrypt and encryption_manager:
-        encrypted_data = encryption_manager.encrypt_data(file_data)
-        data_stream = BytesIO(encrypted_data)
-        upload_size = len(encrypted_data)
         object_name = object_name + ".enc"
-        print(f"Uploaded (new/changed, encrypted): {path} -> {object_name}")
+        print(f"Uploaded (new/changed, encrypted{', ' + codec if codec else ''}): {path} -> {object_name}")
     else:
-        data_stream = BytesIO(file_data)
-        upload_size = file_size
-        print(f"Uploaded (new/changed): {path} -> {object_name}")
+        print(f"Uploaded (new/changed{', ' + codec if codec else ''}): {path} -> {object_name}")
     
-    client.put_object(bucket, object_name, data=data_stream, length=upload_size)
+    file_hash, file_size, object_name = put_file_stream(path, bucket, object_name, file_size, encrypt, codec)
+    if stat_cache and file_size == file_stat.st_size:
+        stat_cache.store(path, file_stat, file_hash)
     
-    return {
+    entry = {
         "local_path": str(path),
         "object_name": object_name,
         "sha256": file_hash,
@@ -138,30 +268,115 @@ def upload_file_incremental(path: Path, bucket: str, object_name: str, previous_
         "skipped": False,
         "encrypted": encrypt
     }
+    if codec:
+        entry["codec"] = codec
+    return entry
 
-def upload_folder(folder: Path, bucket: str, dest_prefix: str, encrypt=False):
-    result = []
-    for root, _, files in os.walk(folder):
-        for fname in files:
+def upload_file_chunked(path: Path, object_name: str, file_stat, chunk_store: ChunkStore):
+    with path.open("rb") as f:
+        file_hash, file_size, chunks, uploaded = chunk_store.upload_stream(f)
+    if stat_cache and file_size == file_stat.st_size:
+        stat_cache.store(path, file_stat, file_hash)
+    print(f"Uploaded (new/changed, chunked): {path} -> {len(chunks)} chunks, {format_size(uploaded)} new")
+    
+    return {
+        "local_path": str(path),
+        "object_name": object_name,
+        "sha256": file_hash,
+        "size": file_size,
+        "skipped": False,
+        "encrypted": chunk_store.encryption_manager is not None,
+        "storage": "chunks",
+        "chunks": chunks,
+        "uploaded_size": uploaded
+    }
+
+def upload_file_packed(path: Path, file_stat, pack_writer: PackWriter):
+    with path.open("rb") as f:
+        data = f.read()
+    file_hash = hashlib.sha256(data).hexdigest()
+    file_size = len(data)
+    codec = choose_codec(path, data[:compression_config.get("probe_size_kb", 64) * 1024], compression_config)
+    if codec:
+        data = compress_bytes(data, codec, compression_config.get("level"))
+    pack_name, offset, length = pack_writer.add(data)
+    if stat_cache and file_size == file_stat.st_size:
+        stat_cache.store(path, file_stat, file_hash)
+    print(f"Packed (new/changed{', ' + codec if codec else ''}): {path} -> {pack_name}")
+    
+    entry = {
+        "local_path": str(path),
+        "object_name": pack_name,
+        "sha256": file_hash,
+        "size": file_size,
+        "skipped": False,
+        "encrypted": pack_writer.encryption_manager is not None,
+        "storage": "pack",
+        "offset": offset,
+        "length": length
+    }
+    if codec:
+        entry["codec"] = codec
+    return entry
+
+def iter_folder_files(folder: Path, dest_prefix: str):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for fname in sorted(files):
             file_path = Path(root) / fname
             rel = file_path.relative_to(folder).as_posix()
-            object_name = f"{dest_prefix}/{rel}"
+            yield file_path, f"{dest_prefix}/{rel}"
+
+def upload_folder(folder: Path, bucket: str, dest_prefix: str, encrypt=False, pack_writer: PackWriter = None):
+    result = []
+    for file_path, object_name in iter_folder_files(folder, dest_prefix):
+        file_stat = file_path.stat()
+        if pack_writer and pack_writer.accepts(file_stat.st_size):
+            info = upload_file_packed(file_path, file_stat, pack_writer)
+        else:
             info = upload_file(file_path, bucket, object_name, encrypt)
-            result.append(info)
+        result.append(info)
     return result
 
-def upload_folder_incremental(folder: Path, bucket: str, dest_prefix: str, previous_metadata: dict, encrypt=False):
-    result = []
-    for root, _, files in os.walk(folder):
-        for fname in files:
-            file_path = Path(root) / fname
-            rel = file_path.relative_to(folder).as_posix()
-            object_name = f"{dest_prefix}/{rel}"
-            info = upload_file_incremental(file_path, bucket, object_name, previous_metadata, encrypt)
-            result.append(info)
+def upload_folder_incremental(folder: Path, bucket: str, dest_prefix: str, previous_entries: EntryIndex, encrypt=False, max_workers=1, errors=None, chunk_store: ChunkStore = None, pack_writer: PackWriter = None, journal: BackupJournal = None, result=None):
+    # result can be any sink with append(), such as the source's manifest
+    if result is None:
+        result = []
+    max_workers = max(1, max_workers)
+    
+    def collect(file_path, future):
+        try:
+            result.append(future.result())
+        except Exception as e:
+            if errors is None:
+                raise
+            print(f"!!! Error uploading {file_path}: {e}")
+            errors.append({"local_path": str(file_path), "error": str(e)})
+    
+    # Futures are collected oldest first so entries keep the walk order, and the
+    # window keeps at most max_workers uploads running with as many queued behind
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file_path, object_name in iter_folder_files(folder, dest_prefix):
+            if len(pending) >= 2 * max_workers:
+                collect(*pending.popleft())
+            future = executor.submit(upload_file_incremental, file_path, bucket, object_name, previous_entries, encrypt, chunk_store, pack_writer, journal)
+            pending.append((file_path, future))
+        while pending:
+            collect(*pending.popleft())
     return result
 
-def backup_database(db_config, path):
+def table_dump_args(tables, snapshot=None):
+    # A table-level delta: data only, for just the named tables and sequences
+    args = ["--snapshot", snapshot] if snapshot else []
+    if tables is None:
+        return args
+    args.append("-a")
+    for table in tables:
+        args += ["-t", table]
+    return args
+
+def backup_database(db_config, path, tables=None, snapshot=None):
     os.makedirs(os.path.dirname(path), exist_ok=True)
     command = [
         "pg_dump",
@@ -170,9 +385,15 @@ def backup_database(db_config, path):
         "-h", db_config["host"], 
         "-p", db_config["port"], 
         "-d", db_config["dbname"], 
-        "-f", path,
-        "-Fc"
-    ]
+        "-f", path
+    ] + table_dump_args(tables, snapshot)
+    if db_config.get("format") == "directory":
+        # One file per table, dumped by N parallel workers; pg_dump refuses
+        # to write into an existing directory
+        shutil.rmtree(path, ignore_errors=True)
+        command += ["-Fd", "-j", str(db_config.get("jobs", 1))]
+    else:
+        command.append("-Fc")
     try:
         env = os.environ.copy()
         env["PGPASSWORD"] = db_config["password"]
@@ -183,8 +404,438 @@ def backup_database(db_config, path):
         print(f"Error occurred while creating the dump: {e}")
         return None
 
+def upload_dump_directory(dump_dir: Path, bucket: str, object_prefix: str, encrypt=False, jobs=1):
+    files = sorted(path for path in dump_dir.iterdir() if path.is_file())
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        file_entries = list(executor.map(
+            lambda path: upload_file(path, bucket, f"{object_prefix}/{path.name}", encrypt),
+            files
+        ))
+    
+    # The dump is one logical entry; its hash covers the name and hash of every file
+    sha = hashlib.sha256()
+    for path, file_entry in zip(files, file_entries):
+        del file_entry["local_path"]
+        file_entry["name"] = path.name
+        sha.update(f"{path.name}\0{file_entry['sha256']}\n".encode("utf-8"))
+    
+    return {
+        "local_path": str(dump_dir),
+        "object_name": f"{object_prefix}/",
+        "sha256": sha.hexdigest(),
+        "size": sum(file_entry["size"] for file_entry in file_entries),
+        "encrypted": encrypt,
+        "format": "directory",
+        "files": file_entries
+    }
+
+def backup_database_stream(db_config, bucket: str, object_name: str, encrypt=False, tables=None, snapshot=None):
+    # pg_dump writes the custom-format archive to stdout, which is hashed and
+    # encrypted on the way into the upload, so no dump file touches the disk.
+    # -Fc output is already compressed by pg_dump, so no codec is applied
+    command = [
+        "pg_dump",
+        "-C",
+        "-U", db_config["user"],
+        "-h", db_config["host"],
+        "-p", db_config["port"],
+        "-d", db_config["dbname"],
+        "-Fc"
+    ] + table_dump_args(tables, snapshot)
+    if encrypt and encryption_manager:
+        object_name = object_name + ".enc"
+    # The dump size is unknown up front and S3 allows at most 10000 parts,
+    # so the part size bounds the largest dump that can be streamed
+    part_size = max(upload_part_size, db_config.get("stream_part_size_mb", 64) * MB)
+    
+    env = os.environ.copy()
+    env["PGPASSWORD"] = db_config["password"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+    try:
+        reader = HashingReader(process.stdout)
+        client.put_object(
+            bucket,
+            object_name,
+            data=build_upload_stream(reader, encrypt),
+            length=-1,
+            part_size=part_size
+        )
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+    
+    if process.wait() != 0:
+        # The upload completed with a truncated dump, don't leave it behind
+        client.remove_object(bucket, object_name)
+        raise Exception(f"pg_dump exited with code {process.returncode}")
+    
+    print(f"Uploaded (streamed{', encrypted' if encrypt and encryption_manager else ''}): pg_dump {db_config['dbname']} -> {object_name}")
+    return {
+        "local_path": db_config["db_temp_path"],
+        "object_name": object_name,
+        "sha256": reader.hexdigest(),
+        "size": reader.size,
+        "encrypted": encrypt
+    }
+
+def db_local_path(db_config):
+    if db_config.get("format") == "directory":
+        return db_config["db_temp_path"] + ".d"
+    return db_config["db_temp_path"]
+
+def backup_database_entry(db_config, bucket: str, dest_prefix: str, encrypt=False, tables=None, snapshot=None):
+    if db_config.get("format") == "directory":
+        dump_dir = Path(db_local_path(db_config))
+        if not backup_database(db_config, str(dump_dir), tables, snapshot):
+            raise Exception("Database backup failed")
+        try:
+            info = upload_dump_directory(dump_dir, bucket, f"{dest_prefix}/{dump_dir.name}", encrypt, db_config.get("jobs", 1))
+        finally:
+            shutil.rmtree(dump_dir, ignore_errors=True)
+    elif db_config.get("streaming", False):
+        object_name = f"{dest_prefix}/{Path(db_config['db_temp_path']).name}"
+        info = backup_database_stream(db_config, bucket, object_name, encrypt, tables, snapshot)
+    else:
+        backup_path = backup_database(db_config, db_config["db_temp_path"], tables, snapshot)
+        if not backup_path:
+            raise Exception("Database backup failed")
+        backup_path = Path(backup_path)
+        object_name = f"{dest_prefix}/{backup_path.name}"
+        info = upload_file(backup_path, bucket, object_name, encrypt)
+        os.remove(db_config["db_temp_path"])
+    info["db_name"] = db_config["dbname"]
+    return info
+
+def backup_database_incremental(db_config, bucket: str, dest_prefix: str, encrypt, previous_entries: EntryIndex):
+    # Checksums, the schema and the dump all come from one exported snapshot,
+    # so a table that changes while this runs is either in the delta or seen
+    # unchanged everywhere. Counters are read before the snapshot is exported
+    # and once more after, tables written to in between are dumped as well.
+    counters = table_counters(db_config)
+    with exported_snapshot(db_config) as snapshot:
+        moved = {table for table, row in table_counters(db_config).items() if counters.get(table) != row}
+        state = database_state(db_config, db_config.get("table_checksums", True), snapshot, counters)
+        return backup_database_changes(db_config, bucket, dest_prefix, encrypt, previous_entries, state, moved, snapshot)
+
+def backup_database_changes(db_config, bucket: str, dest_prefix: str, encrypt, previous_entries: EntryIndex, state, moved, snapshot):
+    previous_entry = previous_entries.get(db_local_path(db_config))
+    changed_tables, reason = plan_backup(previous_entry, state, db_config.get("full_every", 7))
+    if changed_tables is not None and moved - set(changed_tables):
+        changed_tables = sorted(set(changed_tables) | (moved & set(state["tables"])))
+        reason = f"{len(changed_tables)} changed table(s)"
+    
+    if changed_tables is None:
+        print(f"Full database backup of {db_config['dbname']}: {reason}")
+        info = backup_database_entry(db_config, bucket, dest_prefix, encrypt, snapshot=snapshot)
+        info.update(state)
+        info.update({"backup_mode": "full", "chain_length": 0})
+        return info
+    
+    if not changed_tables:
+        print(f"Skipped (unchanged): database {db_config['dbname']}")
+        # Still points at the previous dump (and its parent), with the fresh state
+        skipped_entry = dict(previous_entry)
+        skipped_entry.update(state)
+        skipped_entry.update({"skipped": True, "reason": "unchanged"})
+        return skipped_entry
+    
+    print(f"Incremental database backup of {db_config['dbname']}: {reason}")
+    tables = sorted(changed_tables) + list_sequences(db_config, snapshot)
+    info = backup_database_entry(db_config, bucket, dest_prefix, encrypt, tables, snapshot)
+    info.update(state)
+    info.update({
+        "backup_mode": "incremental",
+        # The snapshot holding the dump this delta applies on top of
+        "parent": previous_entry["object_name"].split("/")[1],
+        "chain_length": previous_entry.get("chain_length", 0) + 1,
+        "changed_tables": sorted(changed_tables)
+    })
+    return info
+
+def backup_one_database(db_config, bucket: str, dest_prefix: str, encrypt, previous_entries: EntryIndex):
+    if db_config.get("incremental", False):
+        return backup_database_incremental(db_config, bucket, dest_prefix, encrypt, previous_entries)
+    return backup_database_entry(db_config, bucket, dest_prefix, encrypt)
+
+def backup_cluster_globals(cluster_config, bucket: str, dest_prefix: str, encrypt=False):
+    # Roles and tablespaces live outside every database, pg_dump never sees them
+    path = Path(globals_path(cluster_config))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    command = [
+        "pg_dumpall",
+        "--globals-only",
+        "-U", cluster_config["user"],
+        "-h", cluster_config["host"],
+        "-p", cluster_config["port"],
+        "-f", str(path)
+    ]
+    env = os.environ.copy()
+    env["PGPASSWORD"] = cluster_config["password"]
+    subprocess.run(command, check=True, env=env)
+    try:
+        info = upload_file(path, bucket, f"{dest_prefix}/{path.name}", encrypt)
+    finally:
+        path.unlink()
+    info["globals"] = True
+    return info
+
+def backup_database_cluster(cluster_config, bucket: str, dest_prefix: str, encrypt, previous_entries: EntryIndex, errors):
+    names = select_databases(
+        list_databases(cluster_config),
+        cluster_config.get("include"),
+        cluster_config.get("exclude")
+    )
+    max_concurrent = max(1, cluster_config.get("max_concurrent", 2))
+    print(f"Dumping {len(names)} database(s), {max_concurrent} at a time")
+    
+    entries = [backup_cluster_globals(cluster_config, bucket, dest_prefix, encrypt)]
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = [
+            (name, executor.submit(backup_one_database, cluster_db_config(cluster_config, name), bucket, dest_prefix, encrypt, previous_entries))
+            for name in names
+        ]
+        for name, future in futures:
+            try:
+                entries.append(future.result())
+            except Exception as e:
+                print(f"!!! Error backing up database {name}: {e}")
+                errors.append({"local_path": name, "error": str(e)})
+    return entries
+
+def read_wal_start(base_tar: Path):
+    # The first WAL segment the base backup needs, from its backup_label
+    with tarfile.open(base_tar) as tar:
+        label = tar.extractfile("backup_label").read().decode("utf-8")
+    match = re.search(r"START WAL LOCATION: .* \(file ([0-9A-F]{24})\)", label)
+    if not match:
+        raise Exception("backup_label has no START WAL LOCATION")
+    return match.group(1)
+
+def backup_base(wal_config, bucket: str, dest_prefix: str, encrypt=False):
+    # A physical base backup; together with the segments wal_archive.py ships
+    # from archive_command it can be rolled forward to any later point in time
+    base_dir = Path(wal_config.get("temp_dir", "/tmp/pgsql/base"))
+    shutil.rmtree(base_dir, ignore_errors=True)
+    base_dir.parent.mkdir(parents=True, exist_ok=True)
+    command = [
+        "pg_basebackup",
+        "-U", wal_config["user"],
+        "-h", wal_config["host"],
+        "-p", wal_config["port"],
+        "-D", str(base_dir),
+        "-Ft",
+        "-X", "stream",
+        "--checkpoint=fast"
+    ]
+    env = os.environ.copy()
+    env["PGPASSWORD"] = wal_config["password"]
+    subprocess.run(command, check=True, env=env)
+    print(f"Base backup {base_dir} has been successfully created.")
+    
+    try:
+        wal_start = read_wal_start(base_dir / "base.tar")
+        info = upload_dump_directory(base_dir, bucket, f"{dest_prefix}/base", encrypt, wal_config.get("jobs", 4))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    info["format"] = "basebackup"
+    info["wal_start"] = wal_start
+    return info
+
+def backup_source(source, bucket: str, timestamp: str, encryption_enabled: bool, chunk_store: ChunkStore = None):
+    source_start_time = time.time()
+    source_name = source["name"]
+    source_type = source["type"]
+    
+    journal = None
+    if source_type == "device" and journal_config.get("enabled", False):
+        journal = BackupJournal.open(
+            journal_config.get("dir", "./backup_journal"),
+            source_name,
+            timestamp,
+            journal_config.get("max_age_hours", 24)
+        )
+        timestamp = journal.timestamp
+    dest_prefix = f"{source_name}/{timestamp}"
+
+    # Initialize source report
+    source_report = {
+        "name": source_name,
+        "type": source_type,
+        "status": "success",
+        "duration": 0,
+        "files_count": 0,
+        "total_size": 0,
+        "error": ""
+    }
+
+    metadata = {
+        "timestamp": timestamp,
+        "bucket": bucket,
+        "source_name": source_name,
+        "source_type": source_type,
+        "encrypted": encryption_enabled
+    }
+    manifest = ManifestWriter.from_config(manifest_config, compression_config)
+
+    print(f"\n=== Backing up source: {source_name} ({source_type}) ===")
+
+    # Built once per source so each file is an O(1) lookup instead of a scan
+    try:
+        previous_entries = EntryIndex.from_entries(iter_entries(client, bucket, get_previous_backup_metadata(bucket, source_name)))
+    except Exception as e:
+        print(f"Could not read the previous manifest for {source_name}, doing a full backup: {e}")
+        previous_entries = EntryIndex()
+    file_errors = []
+
+    try:
+        if source_type == "device":
+            items = source.get("items", [])
+            max_workers = source.get("max_workers", 1)
+            source_chunk_store = chunk_store if source.get("storage") == "chunks" else None
+            pack_writer = PackWriter.from_config(
+                client,
+                bucket,
+                dest_prefix,
+                encryption_manager if encryption_enabled else None,
+                source.get("packing", {})
+            )
+            if pack_writer and journal:
+                pack_writer.on_flush = journal.pack_flushed
+            for item in items:
+                if item["type"] == "folder":
+                    folder = Path(item["path"])
+                    if not folder.exists():
+                        print(f"Preskacem, ne postoji: {folder}")
+                        continue
+                    upload_folder_incremental(folder, bucket, f"{dest_prefix}/{folder.name}", previous_entries, encryption_enabled, max_workers, file_errors, source_chunk_store, pack_writer, journal, manifest)
+                elif item["type"] == "file":
+                    file_path = Path(item["path"])
+                    if not file_path.exists():
+                        print(f"Preskacem, ne postoji: {file_path}")
+                        continue
+                    object_name = f"{dest_prefix}/{file_path.name}"
+                    info = upload_file_incremental(file_path, bucket, object_name, previous_entries, encryption_enabled, source_chunk_store, pack_writer, journal)
+                    manifest.append(info)
+            if pack_writer:
+                pack_writer.close()
+
+        elif source_type == "database":
+            info = backup_one_database(source["db_config"], bucket, dest_prefix, encryption_enabled, previous_entries)
+            manifest.append(info)
+
+        elif source_type == "database_wal":
+            manifest.append(backup_base(source["wal_config"], bucket, dest_prefix, encryption_enabled))
+
+        elif source_type == "database_cluster":
+            entries = backup_database_cluster(source["cluster_config"], bucket, dest_prefix, encryption_enabled, previous_entries, file_errors)
+            manifest.extend(entries)
+
+        source_report["files_count"] = manifest.count
+        source_report["total_size"] = manifest.total_size
+        source_report["files_uploaded"] = manifest.count - manifest.skipped
+        source_report["files_skipped"] = manifest.skipped
+        source_report["files_failed"] = len(file_errors)
+
+        client.put_object(
+            bucket,
+            f"{dest_prefix}/{manifest.object_name}",
+            data=ChunkReader(manifest.chunks()),
+            length=-1,
+            part_size=upload_part_size
+        )
+        metadata["manifest"] = manifest.header()
+        metadata["files_count"] = manifest.count
+        metadata["total_size"] = manifest.total_size
+
+        # metadata.json is written last: a snapshot without it is incomplete
+        metadata_bytes = json.dumps(metadata, indent=2).encode("utf-8")
+        client.put_object(
+            bucket,
+            f"{dest_prefix}/metadata.json",
+            data=BytesIO(metadata_bytes),
+            length=len(metadata_bytes)
+        )
+
+        print(f"Metadata uploaded -> {dest_prefix}/metadata.json")
+        try:
+            record_snapshot(
+                client, bucket, source_name, timestamp,
+                source_report["files_count"], source_report["total_size"]
+            )
+        except Exception as e:
+            print(f"Warning: could not update snapshot index for {source_name}: {e}")
+        if catalog:
+            try:
+                catalog.add_snapshot(metadata, manifest.entries())
+            except Exception as e:
+                print(f"Warning: could not add {dest_prefix} to the local catalog: {e}")
+        if journal:
+            journal.complete()
+            journal = None
+        if file_errors:
+            failed = ", ".join(error["local_path"] for error in file_errors[:5])
+            raise Exception(f"{len(file_errors)} file(s) failed to upload: {failed}")
+        print(f"=== Completed backup for: {source_name} ===\n")
+
+    except Exception as e:
+        print(f"!!! Error backing up {source_name}: {e}")
+        source_report["status"] = "failed"
+        source_report["error"] = str(e)
+    
+    manifest.close()
+    if journal:
+        # Left on disk so the next run finishes this snapshot
+        journal.close()
+
+    if stat_cache:
+        stat_cache.commit()
+    
+    # Record duration
+    source_report["duration"] = time.time() - source_start_time
+    return source_report
+
+def run_sources(sources, run_source, max_parallel=1, resource_limits=None):
+    # Starts the highest priority source whose resource class still has a free
+    # slot, e.g. {"database": 1} keeps database dumps from overlapping
+    resource_limits = resource_limits or {}
+    max_parallel = max(1, max_parallel)
+    pending = sorted(enumerate(sources), key=lambda item: -item[1].get("priority", 0))
+    running = {}
+    class_usage = {}
+    reports = [None] * len(sources)
+    
+    def has_capacity(source):
+        resource_class = source.get("resource_class")
+        if resource_class not in resource_limits:
+            return True
+        return class_usage.get(resource_class, 0) < max(1, resource_limits[resource_class])
+    
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while pending or running:
+            while len(running) < max_parallel:
+                ready = next((item for item in pending if has_capacity(item[1])), None)
+                if ready is None:
+                    break
+                pending.remove(ready)
+                index, source = ready
+                resource_class = source.get("resource_class")
+                class_usage[resource_class] = class_usage.get(resource_class, 0) + 1
+                running[executor.submit(run_source, source)] = (index, source)
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, source = running.pop(future)
+                resource_class = source.get("resource_class")
+                class_usage[resource_class] -= 1
+                reports[index] = future.result()
+    
+    # Reports stay in config order regardless of completion order
+    return reports
+
 def run_backup():
-    global encryption_manager
+    global encryption_manager, upload_part_size, stat_cache, compression_config, multipart_uploader, journal_config, manifest_config, catalog
     
     start_time = time.time()
     start_time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -205,6 +856,33 @@ def run_backup():
             print(f"Warning: Failed to initialize encryption: {e}")
             encryption_enabled = False
 
+    upload_config = config.get("upload", {})
+    upload_part_size = upload_config.get("part_size_mb", 16) * MB
+    compression_config = config.get("compression", {})
+    journal_config = config.get("journal", {})
+    manifest_config = config.get("manifest", {})
+    
+    multipart_uploader = MultipartUploader.from_config(client, config.get("multipart", {}))
+    if multipart_uploader:
+        try:
+            multipart_uploader.cleanup_stale(bucket)
+        except Exception as e:
+            print(f"Warning: Failed to clean up stale multipart uploads: {e}")
+
+    stat_cache_config = config.get("stat_cache", {})
+    if stat_cache_config.get("enabled", False):
+        stat_cache = StatCache(stat_cache_config.get("path", "./backup_state.db"))
+        stat_cache.begin_run(stat_cache_config.get("paranoid_every", 0))
+
+    catalog = Catalog.from_config(config.get("catalog", {}))
+
+    chunk_store = ChunkStore.from_config(
+        client,
+        bucket,
+        encryption_manager if encryption_enabled else None,
+        config.get("chunk_store", {})
+    )
+
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     
     # Initialize report
@@ -216,96 +894,23 @@ def run_backup():
         "sources": []
     }
     
-    overall_success = True
-
-    for source in sources:
-        source_start_time = time.time()
-        source_name = source["name"]
-        source_type = source["type"]
-        dest_prefix = f"{source_name}/{timestamp}"
-        
-        # Initialize source report
-        source_report = {
-            "name": source_name,
-            "type": source_type,
-            "status": "success",
-            "duration": 0,
-            "files_count": 0,
-            "total_size": 0,
-            "error": ""
-        }
-
-        metadata = {
-            "timestamp": timestamp,
-            "bucket": bucket,
-            "source_name": source_name,
-            "source_type": source_type,
-            "encrypted": encryption_enabled,
-            "entries": []
-        }
-
-        print(f"\n=== Backing up source: {source_name} ({source_type}) ===")
-
-        previous_metadata = get_previous_backup_metadata(bucket, source_name)
-        
-        try:
-            if source_type == "device":
-                items = source.get("items", [])
-                for item in items:
-                    if item["type"] == "folder":
-                        folder = Path(item["path"])
-                        if not folder.exists():
-                            print(f"Preskacem, ne postoji: {folder}")
-                            continue
-                        entries = upload_folder_incremental(folder, bucket, f"{dest_prefix}/{folder.name}", previous_metadata, encryption_enabled)
-                        metadata["entries"].extend(entries)
-                    elif item["type"] == "file":
-                        file_path = Path(item["path"])
-                        if not file_path.exists():
-                            print(f"Preskacem, ne postoji: {file_path}")
-                            continue
-                        object_name = f"{dest_prefix}/{file_path.name}"
-                        info = upload_file_incremental(file_path, bucket, object_name, previous_metadata, encryption_enabled)
-                        metadata["entries"].append(info)
-
-            elif source_type == "database":
-                db_config = source["db_config"]
-                backup_path = backup_database(db_config, db_config["db_temp_path"])
-                if backup_path:
-                    backup_path = Path(backup_path)
-                    object_name = f"{dest_prefix}/{backup_path.name}"
-                    info = upload_file(backup_path, bucket, object_name, encryption_enabled)
-                    info["db_name"] = db_config["dbname"]
-                    metadata["entries"].append(info)
-                    os.remove(db_config["db_temp_path"])
-                else:
-                    raise Exception("Database backup failed")
-
-            source_report["files_count"] = len(metadata["entries"])
-            source_report["total_size"] = sum(entry.get("size", 0) for entry in metadata["entries"])
-            source_report["files_uploaded"] = sum(1 for entry in metadata["entries"] if not entry.get("skipped", False))
-            source_report["files_skipped"] = sum(1 for entry in metadata["entries"] if entry.get("skipped", False))
-            
-            metadata_bytes = json.dumps(metadata, indent=2).encode("utf-8")
-            client.put_object(
-                bucket,
-                f"{dest_prefix}/metadata.json",
-                data=BytesIO(metadata_bytes),
-                length=len(metadata_bytes)
-            )
-
-            print(f"Metadata uploaded -> {dest_prefix}/metadata.json")
-            print(f"=== Completed backup for: {source_name} ===\n")
-            
-        except Exception as e:
-            print(f"!!! Error backing up {source_name}: {e}")
-            source_report["status"] = "failed"
-            source_report["error"] = str(e)
-            overall_success = False
-        
-        # Record duration
-        source_report["duration"] = time.time() - source_start_time
-        backup_report["sources"].append(source_report)
+    parallel_config = config.get("parallel", {})
+    max_parallel = parallel_config.get("max_sources", 1)
+    resource_limits = parallel_config.get("resource_limits", {})
+    
+    backup_report["sources"] = run_sources(
+        sources,
+        lambda source: backup_source(source, bucket, timestamp, encryption_enabled, chunk_store),
+        max_parallel,
+        resource_limits
+    )
+    
+    if stat_cache:
+        stat_cache.close()
+        stat_cache = None
+    if catalog:
+        catalog.close()
+        catalog = None
     
     # Finalize report
     end_time = time.time()
@@ -0,0 +1,258 @@
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from minio import Minio
+from email_notifier import format_size
+from snapshot_index import read_index, snapshot_timestamps, list_snapshot_timestamps
+from chunk_store import CHUNK_PREFIX
+from wal_archive import WAL_PREFIX
+from manifest import iter_entries
+
+SNAPSHOT_FIELDS = ("timestamp", "bucket", "source_name", "source_type", "encrypted")
+
+
+class SnapshotEntries:
+    # Lazy view of a snapshot's entries; every iteration reads them again in
+    # rowid batches, so recovery can stream them twice without holding them
+    # in memory or the catalog lock
+
+    def __init__(self, catalog, snapshot_id, count, batch_size=1000):
+        self.catalog = catalog
+        self.snapshot_id = snapshot_id
+        self.count = count
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        last_rowid = 0
+        while True:
+            with self.catalog._lock:
+                rows = self.catalog._conn.execute(
+                    "SELECT rowid, entry FROM entries WHERE snapshot_id = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (self.snapshot_id, last_rowid, self.batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for _, entry in rows:
+                yield json.loads(entry)
+            last_rowid = rows[-1][0]
+
+
+class Catalog:
+
+    def __init__(self, db_path="./backup_catalog.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                name TEXT PRIMARY KEY,
+                source_type TEXT
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL REFERENCES sources(name),
+                timestamp TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                files_count INTEGER NOT NULL,
+                total_size INTEGER NOT NULL,
+                UNIQUE (source, timestamp)
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                snapshot_id INTEGER NOT NULL REFERENCES snapshots(id) ON DELETE CASCADE,
+                local_path TEXT,
+                object_name TEXT,
+                sha256 TEXT,
+                size INTEGER,
+                entry TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_snapshot ON entries (snapshot_id, size);
+            CREATE INDEX IF NOT EXISTS entries_order ON entries (snapshot_id);
+            CREATE INDEX IF NOT EXISTS entries_path ON entries (local_path);
+            CREATE INDEX IF NOT EXISTS entries_hash ON entries (sha256);
+        """)
+        self._conn.commit()
+
+    @classmethod
+    def from_config(cls, catalog_config):
+        if not catalog_config.get("enabled", False):
+            return None
+        return cls(catalog_config.get("path", "./backup_catalog.db"))
+
+    def add_snapshot(self, metadata, entries=None):
+        # entries may be a generator (a streamed manifest); it is consumed once
+        source_name = metadata["source_name"]
+        timestamp = metadata["timestamp"]
+        if entries is None:
+            entries = metadata.get("entries", [])
+        totals = [0, 0]
+
+        def rows(snapshot_id):
+            for entry in entries:
+                totals[0] += 1
+                totals[1] += entry.get("size", 0) or 0
+                yield (snapshot_id, entry.get("local_path"), entry.get("object_name"), entry.get("sha256"), entry.get("size"), json.dumps(entry))
+
+        header = {key: metadata.get(key) for key in SNAPSHOT_FIELDS}
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sources (name, source_type) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET source_type = excluded.source_type",
+                (source_name, metadata.get("source_type"))
+            )
+            self._conn.execute("DELETE FROM snapshots WHERE source = ? AND timestamp = ?", (source_name, timestamp))
+            cursor = self._conn.execute(
+                "INSERT INTO snapshots (source, timestamp, metadata, files_count, total_size) VALUES (?, ?, ?, 0, 0)",
+                (source_name, timestamp, json.dumps(header))
+            )
+            snapshot_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO entries (snapshot_id, local_path, object_name, sha256, size, entry) VALUES (?, ?, ?, ?, ?, ?)",
+                rows(snapshot_id)
+            )
+            self._conn.execute(
+                "UPDATE snapshots SET files_count = ?, total_size = ? WHERE id = ?",
+                (totals[0], totals[1], snapshot_id)
+            )
+
+    def remove_snapshot(self, source_name, timestamp):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM snapshots WHERE source = ? AND timestamp = ?", (source_name, timestamp))
+
+    def sources(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT name FROM sources WHERE name IN (SELECT source FROM snapshots) ORDER BY name").fetchall()
+        return [row[0] for row in rows]
+
+    def snapshots(self, source_name):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT timestamp, files_count, total_size FROM snapshots WHERE source = ? ORDER BY timestamp",
+                (source_name,)
+            ).fetchall()
+        return rows
+
+    def latest_snapshot(self, source_name):
+        with self._lock:
+            row = self._conn.execute("SELECT max(timestamp) FROM snapshots WHERE source = ?", (source_name,)).fetchone()
+        return row[0] if row else None
+
+    def load_metadata(self, source_name, timestamp):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, metadata, files_count, total_size FROM snapshots WHERE source = ? AND timestamp = ?",
+                (source_name, timestamp)
+            ).fetchone()
+        if row is None:
+            return None
+        metadata = json.loads(row[1])
+        metadata["files_count"] = row[2]
+        metadata["total_size"] = row[3]
+        metadata["entries"] = SnapshotEntries(self, row[0], row[2])
+        return metadata
+
+    def snapshots_containing(self, local_path):
+        with self._lock:
+            return self._conn.execute("""
+                SELECT s.source, s.timestamp, e.sha256, e.size
+                FROM entries e JOIN snapshots s ON s.id = e.snapshot_id
+                WHERE e.local_path = ?
+                ORDER BY s.source, s.timestamp
+            """, (str(local_path),)).fetchall()
+
+    def largest_files(self, source_name, timestamp, limit=20):
+        with self._lock:
+            return self._conn.execute("""
+                SELECT e.local_path, e.size, e.sha256
+                FROM entries e JOIN snapshots s ON s.id = e.snapshot_id
+                WHERE s.source = ? AND s.timestamp = ?
+                ORDER BY e.size DESC
+                LIMIT ?
+            """, (source_name, timestamp, limit)).fetchall()
+
+    def sync(self, client, bucket):
+        # Only snapshots the catalog has not seen are downloaded; snapshots
+        # that are gone from the bucket are dropped
+        added = removed = 0
+        for obj in client.list_objects(bucket, recursive=False):
+            source_name = obj.object_name.rstrip('/')
+            if not obj.is_dir or source_name in (CHUNK_PREFIX, WAL_PREFIX):
+                continue
+            index = read_index(client, bucket, source_name)
+            remote = snapshot_timestamps(index) if index else list_snapshot_timestamps(client, bucket, source_name)
+            known = {row[0] for row in self.snapshots(source_name)}
+            for timestamp in remote:
+                if timestamp in known:
+                    continue
+                try:
+                    response = client.get_object(bucket, f"{source_name}/{timestamp}/metadata.json")
+                except Exception:
+                    continue
+                try:
+                    metadata = json.loads(response.read().decode("utf-8"))
+                finally:
+                    response.close()
+                    response.release_conn()
+                self.add_snapshot(metadata, iter_entries(client, bucket, metadata))
+                added += 1
+            for timestamp in known - set(remote):
+                self.remove_snapshot(source_name, timestamp)
+                removed += 1
+        return added, removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("  Sync from bucket:      python catalog.py sync")
+        print("  List snapshots:        python catalog.py snapshots <source_name>")
+        print("  Snapshots with a file: python catalog.py find <local_path>")
+        print("  Largest files:         python catalog.py largest <source_name> <timestamp> [count]")
+        sys.exit(1)
+
+    with open(os.environ.get("BACKUP_CONFIG", "config.json"), "r") as f:
+        config = json.load(f)
+    catalog = Catalog(config.get("catalog", {}).get("path", "./backup_catalog.db"))
+    command = sys.argv[1]
+
+    if command == "sync":
+        client = Minio(
+            "localhost:9000",
+            access_key="suispapp",
+            secret_key="suispappsecret",
+            secure=False
+        )
+        added, removed = catalog.sync(client, config["bucket"])
+        print(f"Catalog synced: {added} snapshot(s) added, {removed} removed")
+
+    elif command == "snapshots" and len(sys.argv) > 2:
+        for timestamp, files_count, total_size in catalog.snapshots(sys.argv[2]):
+            print(f"{timestamp}  {files_count:>8} files  {format_size(total_size):>10}")
+
+    elif command == "find" and len(sys.argv) > 2:
+        rows = catalog.snapshots_containing(Path(sys.argv[2]))
+        if not rows:
+            print(f"No snapshot contains {sys.argv[2]}")
+        for source_name, timestamp, sha256, size in rows:
+            print(f"{source_name}/{timestamp}  {format_size(size or 0):>10}  {sha256}")
+
+    elif command == "largest" and len(sys.argv) > 3:
+        count = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+        for local_path, size, sha256 in catalog.largest_files(sys.argv[2], sys.argv[3], count):
+            print(f"{format_size(size or 0):>10}  {local_path}")
+
+    else:
+        print(f"Unknown or incomplete command: {' '.join(sys.argv[1:])}")
+        sys.exit(1)
+    catalog.close()
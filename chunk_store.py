@@ -0,0 +1,200 @@
+import hashlib
+import hmac
+import threading
+from io import BytesIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK_PREFIX = "chunks"
+MASK64 = (1 << 64) - 1
+
+# Gear table for the rolling hash, derived deterministically so chunk
+# boundaries are stable across runs and hosts
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+# Positions hashed per array pass; small enough to stay in cache and to stop
+# soon after the cut point
+SCAN_BLOCK = 64 * 1024
+
+
+def chunk_object_name(chunk_id):
+    return f"{CHUNK_PREFIX}/{chunk_id[:2]}/{chunk_id}"
+
+
+def top_bits_mask(bits):
+    # The gear hash shifts left, so the top bits depend on the last 64 bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def gear_hashes(data, origin, start, end):
+    # The hash after each byte in [start, end) for a gear hash started at
+    # origin. Every byte shifts the hash left once, so it only depends on the
+    # last 64 bytes and can be built from windows of doubling width with a
+    # handful of array operations instead of a Python step per byte.
+    context = max(origin, start - 63)
+    h = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8, count=end - context, offset=context)]
+    shifted = numpy.empty_like(h)
+    count = len(h)
+    width = 1
+    while width < 64 and width < count:
+        numpy.left_shift(h[:-width], numpy.uint64(width), out=shifted[:count - width])
+        h[width:] += shifted[:count - width]
+        width *= 2
+    return h[start - context:]
+
+
+def find_cut_point_vectorized(data, min_size, avg_size, max_size):
+    length = min(len(data), max_size)
+    if length <= min_size:
+        return length
+    bits = max(1, avg_size.bit_length() - 1)
+    barrier = max(min_size, min(avg_size, length))
+    for region_start, region_end, mask in ((min_size, barrier, top_bits_mask(bits + 1)), (barrier, length, top_bits_mask(bits - 1))):
+        for start in range(region_start, region_end, SCAN_BLOCK):
+            end = min(start + SCAN_BLOCK, region_end)
+            hits = numpy.flatnonzero((gear_hashes(data, min_size, start, end) & numpy.uint64(mask)) == 0)
+            if len(hits):
+                return start + int(hits[0]) + 1
+    return length
+
+
+def find_cut_point(data, min_size, avg_size, max_size):
+    if numpy is not None:
+        return find_cut_point_vectorized(data, min_size, avg_size, max_size)
+    # FastCDC: no cut before min_size, a stricter mask until avg_size and a
+    # looser one after it so chunk sizes cluster around avg_size
+    length = min(len(data), max_size)
+    if length <= min_size:
+        return length
+    bits = max(1, avg_size.bit_length() - 1)
+    mask_small = top_bits_mask(bits + 1)
+    mask_large = top_bits_mask(bits - 1)
+    gear = GEAR
+    
+    h = 0
+    barrier = max(min_size, min(avg_size, length))
+    with memoryview(data) as view:
+        for i, byte in enumerate(view[min_size:barrier], min_size):
+            h = ((h << 1) + gear[byte]) & MASK64
+            if not h & mask_small:
+                return i + 1
+        for i, byte in enumerate(view[barrier:length], barrier):
+            h = ((h << 1) + gear[byte]) & MASK64
+            if not h & mask_large:
+                return i + 1
+    return length
+
+
+def iter_content_chunks(stream, min_size, avg_size, max_size):
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = stream.read(max_size)
+            if not data:
+                eof = True
+            else:
+                buffer += data
+        if not buffer:
+            return
+        cut = find_cut_point(buffer, min_size, avg_size, max_size)
+        chunk = bytes(buffer[:cut])
+        del buffer[:cut]
+        yield chunk
+
+
+class ChunkStore:
+    
+    def __init__(self, client, bucket, encryption_manager=None, min_size=256 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024):
+        self.client = client
+        self.bucket = bucket
+        self.encryption_manager = encryption_manager
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self._known = set()
+        self._warned_slow = False
+        self._lock = threading.Lock()
+        self._id_key = None
+        if encryption_manager:
+            # Keyed ids so chunk names don't reveal plaintext hashes
+            self._id_key = hashlib.sha256(b"suisp-chunk-id" + encryption_manager.key).digest()
+    
+    @classmethod
+    def from_config(cls, client, bucket, encryption_manager, chunk_config):
+        return cls(
+            client,
+            bucket,
+            encryption_manager,
+            min_size=chunk_config.get("min_size_kb", 256) * 1024,
+            avg_size=chunk_config.get("avg_size_kb", 1024) * 1024,
+            max_size=chunk_config.get("max_size_kb", 4096) * 1024
+        )
+    
+    def chunk_id(self, data):
+        if self._id_key:
+            return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+    
+    def object_name(self, chunk_id):
+        return chunk_object_name(chunk_id)
+    
+    def has_chunk(self, chunk_id):
+        with self._lock:
+            if chunk_id in self._known:
+                return True
+        try:
+            self.client.stat_object(self.bucket, self.object_name(chunk_id))
+        except Exception:
+            return False
+        with self._lock:
+            self._known.add(chunk_id)
+        return True
+    
+    def put_chunk(self, chunk_id, data):
+        if self.encryption_manager:
+            data = self.encryption_manager.encrypt_data(data)
+        self.client.put_object(self.bucket, self.object_name(chunk_id), data=BytesIO(data), length=len(data))
+        with self._lock:
+            self._known.add(chunk_id)
+    
+    def upload_stream(self, stream):
+        if numpy is None and not self._warned_slow:
+            self._warned_slow = True
+            print("Warning: numpy is not installed, chunk boundaries are found one byte at a time (a few MB/s per file)")
+        sha = hashlib.sha256()
+        size = 0
+        uploaded = 0
+        chunks = []
+        for data in iter_content_chunks(stream, self.min_size, self.avg_size, self.max_size):
+            sha.update(data)
+            size += len(data)
+            chunk_id = self.chunk_id(data)
+            if not self.has_chunk(chunk_id):
+                self.put_chunk(chunk_id, data)
+                uploaded += len(data)
+            chunks.append([chunk_id, len(data)])
+        return sha.hexdigest(), size, chunks, uploaded
+    
+    def get_chunk(self, chunk_id, encrypted=False):
+        response = self.client.get_object(self.bucket, self.object_name(chunk_id))
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        if encrypted:
+            if not self.encryption_manager:
+                raise ValueError("Chunk is encrypted but no encryption key available")
+            data = self.encryption_manager.decrypt_data(data)
+        return data
+    
+    def restore_stream(self, chunks, output, encrypted=False):
+        for chunk_id, size in chunks:
+            data = self.get_chunk(chunk_id, encrypted)
+            if len(data) != size:
+                raise ValueError(f"Chunk {chunk_id} has size {len(data)}, expected {size}")
+            output.write(data)
@@ -0,0 +1,134 @@
+import lzma
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_LEVELS = {"zlib": 6, "lzma": 6, "zstd": 3}
+
+# Formats that are already compressed (or encrypted), recognised by extension
+# or by their leading bytes
+COMPRESSED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".lz4",
+    ".mp3", ".mp4", ".mkv", ".avi", ".mov", ".ogg", ".flac",
+    ".docx", ".xlsx", ".pptx", ".odt", ".jar", ".apk", ".enc"
+}
+COMPRESSED_MAGIC = [
+    b"\x1f\x8b",                # gzip
+    b"PK\x03\x04",              # zip and friends
+    b"\xff\xd8\xff",            # jpeg
+    b"\x89PNG",                 # png
+    b"GIF8",                    # gif
+    b"BZh",                     # bzip2
+    b"\xfd7zXZ\x00",            # xz
+    b"\x28\xb5\x2f\xfd",        # zstd
+    b"7z\xbc\xaf\x27\x1c",      # 7z
+    b"Rar!",                    # rar
+    b"PGDMP",                   # pg_dump -Fc, compressed by default
+    b"SUISPENC",                # our own encrypted stream format
+]
+
+
+def is_available(codec):
+    if codec == "zstd":
+        return zstandard is not None
+    return codec in ("zlib", "lzma")
+
+
+def get_compressor(codec, level=None):
+    if level is None:
+        level = DEFAULT_LEVELS.get(codec)
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=level)
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def get_decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "lzma":
+        return lzma.LZMADecompressor()
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compressed data needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def compress_bytes(data, codec, level=None):
+    compressor = get_compressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_stream(codec, chunks):
+    decompressor = get_decompressor(codec)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    flush = getattr(decompressor, "flush", None)
+    if flush:
+        data = flush()
+        if data:
+            yield data
+
+
+def decompress_bytes(data, codec):
+    return b"".join(decompress_stream(codec, [data]))
+
+
+def looks_compressed(name, probe):
+    if os.path.splitext(str(name))[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    if any(probe.startswith(magic) for magic in COMPRESSED_MAGIC):
+        return True
+    # mp4/mov/heic keep their signature at offset 4
+    return probe[4:8] == b"ftyp"
+
+
+def choose_codec(name, probe, compression_config):
+    if not compression_config or not compression_config.get("enabled", False) or not probe:
+        return None
+    codec = compression_config.get("codec", "zlib")
+    if not is_available(codec):
+        codec = "zlib"
+    if looks_compressed(name, probe):
+        return None
+    # Quick trial on the first block; incompressible data is stored as is
+    ratio = len(zlib.compress(probe, 1)) / len(probe)
+    if ratio > compression_config.get("min_ratio", 0.9):
+        return None
+    return codec
+
+
+class CompressingReader:
+    
+    def __init__(self, stream, codec, level=None, block_size=1024 * 1024):
+        self._stream = stream
+        self._compressor = get_compressor(codec, level)
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._eof = False
+    
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._stream.read(self._block_size)
+            if data:
+                self._buffer += self._compressor.compress(data)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        with memoryview(self._buffer) as view:
+            data = view[:size].tobytes()
+        del self._buffer[:size]
+        return data
@@ -0,0 +1,182 @@
+import os
+import json
+from datetime import datetime
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from minio import Minio
+from minio.commonconfig import ComposeSource
+
+from manifest import ManifestWriter, ChunkReader, iter_entries
+from snapshot_index import read_index, snapshot_timestamps, list_snapshot_timestamps, record_snapshot
+from retention import TIMESTAMP_FORMAT, METADATA_NAME, read_metadata, load_config
+from catalog import Catalog
+
+client = Minio(
+    "localhost:9000",
+    access_key="suispapp",
+    secret_key="suispappsecret",
+    secure=False
+)
+
+HEADER_FIELDS = ("bucket", "source_name", "source_type", "encrypted")
+
+
+def relocate(object_name, source_name, timestamp):
+    # <source>/<any timestamp>/<path> -> <source>/<timestamp>/<path>
+    parts = object_name.split("/", 2)
+    if len(parts) < 3 or parts[0] != source_name:
+        return object_name
+    return f"{source_name}/{timestamp}/{parts[2]}"
+
+
+def plan_entry(entry, source_name, timestamp):
+    # Returns the rewritten entry and the (old, new) object names to copy
+    entry = dict(entry)
+    if entry.get("storage") == "chunks" or entry.get("backup_mode") == "incremental":
+        # Chunks are content-addressed and shared by every snapshot already;
+        # a table-level delta only restores on top of its parent chain, which
+        # cannot be merged without pg_restore, so both are left where they are
+        return entry, []
+    copies = []
+    if entry.get("format") in ("directory", "basebackup"):
+        files = []
+        for file_entry in entry.get("files", []):
+            object_name = relocate(file_entry["object_name"], source_name, timestamp)
+            copies.append((file_entry["object_name"], object_name))
+            files.append(dict(file_entry, object_name=object_name))
+        entry["files"] = files
+        entry["object_name"] = relocate(entry["object_name"], source_name, timestamp)
+    elif entry.get("object_name"):
+        object_name = relocate(entry["object_name"], source_name, timestamp)
+        copies.append((entry["object_name"], object_name))
+        entry["object_name"] = object_name
+    if copies:
+        entry["skipped"] = True
+        entry["reason"] = "consolidated"
+    return entry, copies
+
+
+def copy_server_side(client, bucket, source_object, target_object):
+    # compose_object issues a plain copy_object for sources up to 5 GiB and
+    # splits larger ones into upload_part_copy calls; either way the data
+    # never leaves the object store
+    client.compose_object(bucket, target_object, [ComposeSource(bucket, source_object)])
+    return target_object
+
+
+def latest_metadata(client, bucket, source_name):
+    index = read_index(client, bucket, source_name)
+    timestamps = snapshot_timestamps(index) if index else list_snapshot_timestamps(client, bucket, source_name)
+    for timestamp in reversed(timestamps):
+        try:
+            return read_metadata(client, bucket, source_name, timestamp)
+        except Exception:
+            continue
+    return None
+
+
+def consolidate_source(client, bucket, source_name, config, catalog=None):
+    consolidate_config = config.get("consolidate", {})
+    metadata = latest_metadata(client, bucket, source_name)
+    if metadata is None:
+        print(f"No completed snapshot of '{source_name}' to consolidate.")
+        return None
+
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    if timestamp <= metadata["timestamp"]:
+        raise Exception(f"latest snapshot {metadata['timestamp']} of '{source_name}' is not older than {timestamp}")
+    dest_prefix = f"{source_name}/{timestamp}"
+
+    # The manifest is streamed through once; copies are deduplicated because
+    # packed entries share their pack object
+    manifest = ManifestWriter.from_config(config.get("manifest", {}), config.get("compression", {}))
+    copies = {}
+    prefixes = set()
+    left_in_place = 0
+    try:
+        for entry in iter_entries(client, bucket, metadata):
+            new_entry, entry_copies = plan_entry(entry, source_name, timestamp)
+            if not entry_copies and entry.get("object_name"):
+                left_in_place += 1
+            for source_object, target_object in entry_copies:
+                copies[source_object] = target_object
+                prefixes.add(source_object.split("/", 2)[1])
+            manifest.append(new_entry)
+
+        if len(prefixes) < consolidate_config.get("min_prefixes", 2):
+            print(f"'{source_name}/{metadata['timestamp']}' references {len(prefixes)} snapshot prefix(es), nothing to consolidate.")
+            return None
+
+        print(f"\n=== Consolidating {source_name}/{metadata['timestamp']} ({len(prefixes)} prefixes) -> {dest_prefix} ===")
+        with ThreadPoolExecutor(max_workers=max(1, consolidate_config.get("max_workers", 8))) as executor:
+            list(executor.map(lambda item: copy_server_side(client, bucket, *item), copies.items()))
+        print(f"Copied {len(copies)} object(s) server-side")
+
+        client.put_object(
+            bucket,
+            f"{dest_prefix}/{manifest.object_name}",
+            data=ChunkReader(manifest.chunks()),
+            length=-1,
+            part_size=config.get("upload", {}).get("part_size_mb", 16) * 1024 * 1024
+        )
+        new_metadata = {key: metadata.get(key) for key in HEADER_FIELDS}
+        new_metadata.update({
+            "timestamp": timestamp,
+            "consolidated_from": metadata["timestamp"],
+            "manifest": manifest.header(),
+            "files_count": manifest.count,
+            "total_size": manifest.total_size
+        })
+        metadata_bytes = json.dumps(new_metadata, indent=2).encode("utf-8")
+        client.put_object(bucket, f"{dest_prefix}/{METADATA_NAME}", data=BytesIO(metadata_bytes), length=len(metadata_bytes))
+        print(f"Metadata uploaded -> {dest_prefix}/{METADATA_NAME}")
+
+        try:
+            record_snapshot(client, bucket, source_name, timestamp, manifest.count, manifest.total_size)
+        except Exception as e:
+            print(f"Warning: could not update snapshot index for {source_name}: {e}")
+        if catalog:
+            try:
+                catalog.add_snapshot(new_metadata, manifest.entries())
+            except Exception as e:
+                print(f"Warning: could not add {dest_prefix} to the local catalog: {e}")
+        if left_in_place:
+            print(f"{left_in_place} entr{'y' if left_in_place == 1 else 'ies'} (chunked files, incremental dumps) still point at shared objects")
+        return timestamp
+    finally:
+        manifest.close()
+
+
+def run_consolidation(source_names, config=None):
+    config = config or load_config()
+    bucket = config["bucket"]
+    catalog = Catalog.from_config(config.get("catalog", {}))
+    results = {}
+    try:
+        for source_name in source_names:
+            try:
+                results[source_name] = consolidate_source(client, bucket, source_name, config, catalog)
+            except Exception as e:
+                print(f"!!! Error consolidating {source_name}: {e}")
+                results[source_name] = None
+    finally:
+        if catalog:
+            catalog.close()
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("  Synthetic full snapshot of sources: python consolidate.py <source_name> [<source_name> ...]")
+        print("  All configured sources:             python consolidate.py --all")
+        sys.exit(1)
+
+    config = load_config(os.environ.get("BACKUP_CONFIG", "config.json"))
+    if sys.argv[1:] == ["--all"]:
+        source_names = [source["name"] for source in config.get("backup_sources", [])]
+    else:
+        source_names = sys.argv[1:]
+    run_consolidation(source_names, config)
@@ -0,0 +1,46 @@
+import os
+from fnmatch import fnmatch
+
+from db_incremental import run_psql, quote_literal
+
+MAINTENANCE_DB = "postgres"
+
+
+def maintenance_config(cluster_config):
+    return dict(cluster_config, dbname=cluster_config.get("maintenance_db", MAINTENANCE_DB))
+
+
+def list_databases(cluster_config):
+    rows = run_psql(
+        maintenance_config(cluster_config),
+        "SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate ORDER BY 1"
+    )
+    return [row[0] for row in rows]
+
+
+def select_databases(names, include=None, exclude=None):
+    include = include or ["*"]
+    exclude = exclude or []
+    return [
+        name for name in names
+        if any(fnmatch(name, pattern) for pattern in include)
+        and not any(fnmatch(name, pattern) for pattern in exclude)
+    ]
+
+
+def cluster_db_config(cluster_config, db_name):
+    # Each database is dumped and restored like a standalone database source
+    temp_dir = cluster_config.get("db_temp_dir", "/tmp/pgsql/cluster")
+    return dict(cluster_config, dbname=db_name, db_temp_path=os.path.join(temp_dir, f"{db_name}.dump"))
+
+
+def globals_path(cluster_config):
+    return os.path.join(cluster_config.get("db_temp_dir", "/tmp/pgsql/cluster"), "globals.sql")
+
+
+def ensure_database(cluster_config, db_name):
+    rows = run_psql(maintenance_config(cluster_config), f"SELECT 1 FROM pg_database WHERE datname = {quote_literal(db_name)}")
+    if not rows:
+        quoted = '"' + db_name.replace('"', '""') + '"'
+        run_psql(maintenance_config(cluster_config), f"CREATE DATABASE {quoted}")
+        print(f"  Created database '{db_name}'")
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+# Cumulative per-table counters; any difference from the previous snapshot
+# means rows were written since
+COUNTER_COLUMNS = ("n_tup_ins", "n_tup_upd", "n_tup_del")
+
+
+def pg_env(db_config):
+    env = os.environ.copy()
+    env["PGPASSWORD"] = db_config["password"]
+    return env
+
+
+def psql_command(db_config, *args):
+    return [
+        "psql",
+        "-U", db_config["user"],
+        "-h", db_config["host"],
+        "-p", db_config["port"],
+        "-d", db_config["dbname"],
+        "-v", "ON_ERROR_STOP=1",
+        *args
+    ]
+
+
+def run_psql(db_config, sql, snapshot=None):
+    statements = ["-c", sql]
+    if snapshot:
+        # Reads the data as of a snapshot exported by exported_snapshot
+        statements = [
+            "-c", "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY",
+            "-c", f"SET TRANSACTION SNAPSHOT {quote_literal(snapshot)}",
+            "-c", sql,
+            "-c", "COMMIT"
+        ]
+    command = psql_command(db_config, "-q", "-At", "-F", "\t", *statements)
+    result = subprocess.run(command, check=True, env=pg_env(db_config), capture_output=True, text=True)
+    return [line.split("\t") for line in result.stdout.splitlines() if line]
+
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+@contextmanager
+def exported_snapshot(db_config):
+    # Holds a repeatable-read transaction open in a psql session and yields its
+    # exported snapshot id, so queries (run_psql) and pg_dump --snapshot all
+    # see the same data until the block ends
+    process = subprocess.Popen(
+        psql_command(db_config, "-q", "-At"),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=pg_env(db_config), text=True
+    )
+    try:
+        process.stdin.write("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;\nSELECT pg_export_snapshot();\n")
+        process.stdin.flush()
+        snapshot = process.stdout.readline().strip()
+        if not snapshot:
+            process.stdin.close()
+            process.wait()
+            raise Exception(f"could not export a snapshot of {db_config['dbname']}: {process.stderr.read().strip()}")
+        yield snapshot
+        process.stdin.write("COMMIT;\n")
+        process.stdin.close()
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def schema_hash(db_config, snapshot=None):
+    # Any DDL (new, dropped or altered tables) changes the schema-only dump,
+    # which forces a full backup instead of a table-level delta
+    command = [
+        "pg_dump",
+        "-s",
+        "-U", db_config["user"],
+        "-h", db_config["host"],
+        "-p", db_config["port"],
+        "-d", db_config["dbname"]
+    ]
+    if snapshot:
+        command += ["--snapshot", snapshot]
+    sha = hashlib.sha256()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=pg_env(db_config))
+    with process.stdout:
+        for line in process.stdout:
+            # pg_dump 17.6/16.10/15.14 and later wrap the dump in \restrict
+            # and \unrestrict with a random key that differs on every run
+            if line.startswith((b"\\restrict", b"\\unrestrict")):
+                continue
+            sha.update(line)
+    if process.wait() != 0:
+        raise Exception(f"pg_dump -s exited with code {process.returncode}")
+    return sha.hexdigest()
+
+
+def table_checksums(db_config, tables, snapshot=None):
+    # Order-independent content checksum (row count plus the sum of a 60-bit
+    # slice of each row's md5), so it runs in constant memory. This reads
+    # every table once per run.
+    if not tables:
+        return {}
+    queries = [
+        f"SELECT {quote_literal(table)}, count(*), "
+        f"coalesce(sum(('x' || substr(md5(t::text), 1, 15))::bit(60)::bigint), 0) FROM {table} t"
+        for table in tables
+    ]
+    rows = run_psql(db_config, " UNION ALL ".join(queries), snapshot)
+    return {table: f"{count}:{total}" for table, count, total in rows}
+
+
+def list_sequences(db_config, snapshot=None):
+    rows = run_psql(db_config, "SELECT format('%I.%I', schemaname, sequencename) FROM pg_sequences ORDER BY 1", snapshot)
+    return [row[0] for row in rows]
+
+
+def table_counters(db_config):
+    # Statistics are not transactional, they are read outside any snapshot
+    columns = ", ".join(COUNTER_COLUMNS)
+    rows = run_psql(db_config, f"SELECT format('%I.%I', schemaname, relname), {columns} FROM pg_stat_user_tables ORDER BY 1")
+    return {row[0]: [int(value) for value in row[1:]] for row in rows}
+
+
+def database_state(db_config, checksums=True, snapshot=None, counters=None):
+    # counters should be read before the snapshot is exported: writes that
+    # land in between are then in the dump and show up again next run
+    if counters is None:
+        counters = table_counters(db_config)
+    tables = {table: row + [None] for table, row in counters.items()}
+    if checksums:
+        for table, checksum in table_checksums(db_config, list(tables), snapshot).items():
+            tables[table][-1] = checksum
+
+    stats_reset = run_psql(db_config, "SELECT coalesce(stats_reset::text, '') FROM pg_stat_database WHERE datname = current_database()")
+    return {
+        "schema_sha256": schema_hash(db_config, snapshot),
+        "stats_reset": stats_reset[0][0] if stats_reset else "",
+        "tables": tables
+    }
+
+
+def plan_backup(previous_entry, state, full_every=7):
+    # Returns (changed tables, reason); None means a full dump is needed
+    if not previous_entry or "tables" not in previous_entry:
+        return None, "no previous table state"
+    if previous_entry.get("schema_sha256") != state["schema_sha256"]:
+        return None, "schema changed"
+    if previous_entry.get("chain_length", 0) >= full_every:
+        return None, f"{full_every} incremental backups since the last full one"
+
+    # Counters restart from zero after a stats reset, so only checksums can
+    # be compared across one
+    counters_valid = previous_entry.get("stats_reset") == state["stats_reset"]
+    has_checksums = all(row[-1] is not None for row in state["tables"].values())
+    if not counters_valid and not has_checksums:
+        return None, "statistics were reset"
+
+    changed = []
+    for table, row in state["tables"].items():
+        previous_row = previous_entry["tables"].get(table)
+        if previous_row is None:
+            changed.append(table)
+        elif counters_valid and row[:-1] != previous_row[:-1]:
+            changed.append(table)
+        elif has_checksums and row[-1] != previous_row[-1]:
+            changed.append(table)
+    return changed, f"{len(changed)} changed table(s)"
+
+
+def reload_tables(db_config, tables, script_command):
+    # Empties the tables and replays the data-only script printed by
+    # script_command (pg_restore -f -) in a single transaction, so a reload
+    # that fails half way leaves the tables as they were. Replica mode skips
+    # FK triggers so tables can be emptied in any order (needs a superuser).
+    statements = ["SET session_replication_role = replica;"]
+    statements += [f"DELETE FROM {table};" for table in tables]
+    with tempfile.TemporaryFile() as output:
+        psql = subprocess.Popen(psql_command(db_config, "-q", "--single-transaction"), stdin=subprocess.PIPE, stdout=output, stderr=output, env=pg_env(db_config))
+        script = None
+        try:
+            psql.stdin.write(("\n".join(statements) + "\n").encode("utf-8"))
+            script = subprocess.Popen(script_command, stdout=subprocess.PIPE, stderr=output)
+            with script.stdout:
+                shutil.copyfileobj(script.stdout, psql.stdin, 1024 * 1024)
+            if script.wait() != 0:
+                raise Exception(f"{script_command[0]} exited with code {script.returncode}")
+            psql.stdin.close()
+        except BrokenPipeError:
+            # psql stopped on an error and rolled back; its output says why
+            pass
+        except Exception:
+            psql.kill()
+            psql.wait()
+            raise
+        finally:
+            if script and script.poll() is None:
+                script.kill()
+                script.wait()
+        if psql.wait() != 0:
+            output.seek(0)
+            raise Exception(f"psql exited with code {psql.returncode}: {output.read().decode('utf-8', errors='replace')}")
@@ -1,12 +1,80 @@
 import os
 import base64
+import struct
+from io import BytesIO
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from pathlib import Path
 
 #python encryption.py generate ./encryption.key
 
+# Chunked format: header (magic, version, segment size, salt) followed by
+# segments of SEGMENT_SIZE plaintext bytes, each sealed on its own with the
+# header, index and final flag bound into the AAD. Version 2 seals them under a
+# per-object key derived with HKDF from the master key and a 16-byte random salt,
+# with nonce = index; version 1 (read only) used the master key with
+# nonce = 8-byte random prefix + index.
+STREAM_MAGIC = b"SUISPENC"
+STREAM_VERSION = 2
+SEGMENT_SIZE = 1024 * 1024
+TAG_SIZE = 16
+PREAMBLE_FORMAT = ">8sBI"
+PREAMBLE_SIZE = struct.calcsize(PREAMBLE_FORMAT)
+SALT_SIZES = {1: 8, 2: 16}
+STREAM_KEY_INFO = b"SUISPENC stream key v2"
+LEGACY_NONCE_SIZE = 12
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        parts.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(parts)
+
+
+def readinto_exactly(stream, view):
+    readinto = getattr(stream, "readinto", None)
+    total = 0
+    while total < len(view):
+        if readinto:
+            count = readinto(view[total:])
+        else:
+            chunk = stream.read(len(view) - total)
+            count = len(chunk)
+            view[total:total + count] = chunk
+        if not count:
+            break
+        total += count
+    return total
+
+
+def iter_segments(input_stream, segment_size):
+    # Alternates between two preallocated buffers so there is always one segment
+    # of lookahead to tell whether the current one is final. A yielded view is
+    # only valid until the generator is advanced again.
+    views = [memoryview(bytearray(segment_size)), memoryview(bytearray(segment_size))]
+    current = 0
+    count = readinto_exactly(input_stream, views[current])
+    while True:
+        following = 1 - current
+        next_count = readinto_exactly(input_stream, views[following]) if count == segment_size else 0
+        yield views[current][:count], next_count == 0
+        if next_count == 0:
+            break
+        current, count = following, next_count
+
+
 class EncryptionManager:
     
     def __init__(self, key_file=None, password=None):
@@ -48,18 +116,130 @@ class EncryptionManager:
         with open(key_file, 'rb') as f:
             return base64.b64decode(f.read())
     
+    def _parse_preamble(self, preamble):
+        if len(preamble) != PREAMBLE_SIZE:
+            raise ValueError("Encrypted stream header is truncated")
+        magic, version, segment_size = struct.unpack(PREAMBLE_FORMAT, preamble)
+        if magic != STREAM_MAGIC:
+            raise ValueError("Not a chunked encrypted stream")
+        if version not in SALT_SIZES:
+            raise ValueError(f"Unsupported encrypted stream version: {version}")
+        return version, segment_size
+    
+    def _parse_header(self, header):
+        # Returns the header as stored (it is part of every segment's AAD), the
+        # segment size and the cipher and nonces for its segments
+        version, segment_size = self._parse_preamble(header[:PREAMBLE_SIZE])
+        header = header[:PREAMBLE_SIZE + SALT_SIZES[version]]
+        salt = header[PREAMBLE_SIZE:]
+        if len(salt) != SALT_SIZES[version]:
+            raise ValueError("Encrypted stream header is truncated")
+        return header, segment_size, self._stream_cipher(version, salt)
+    
+    def _stream_cipher(self, version, salt):
+        if version == 1:
+            return self.cipher, lambda index: salt + struct.pack(">I", index)
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=STREAM_KEY_INFO).derive(self.key)
+        return AESGCM(key), lambda index: struct.pack(">4xQ", index)
+    
+    def _segment_aad(self, header, index, final):
+        return header + struct.pack(">QB", index, 1 if final else 0)
+    
+    def _seal_segment(self, header, stream_cipher, index, segment, final):
+        cipher, nonce = stream_cipher
+        return cipher.encrypt(nonce(index), segment, self._segment_aad(header, index, final))
+    
+    def _open_segment(self, header, stream_cipher, index, sealed, final):
+        cipher, nonce = stream_cipher
+        return cipher.decrypt(nonce(index), sealed, self._segment_aad(header, index, final))
+    
+    def is_chunked(self, data):
+        return data[:len(STREAM_MAGIC)] == STREAM_MAGIC
+    
     def encrypt_data(self, data):
-        nonce = os.urandom(12)
         if isinstance(data, str):
             data = data.encode()
-        ciphertext = self.cipher.encrypt(nonce, data, None)
-        return nonce + ciphertext
+        return b"".join(self.encrypt_stream(BytesIO(data)))
     
     def decrypt_data(self, encrypted_data):
-        nonce = encrypted_data[:12]
-        ciphertext = encrypted_data[12:]
+        if self.is_chunked(encrypted_data):
+            return b"".join(self.decrypt_stream(BytesIO(encrypted_data)))
+        nonce = encrypted_data[:LEGACY_NONCE_SIZE]
+        ciphertext = encrypted_data[LEGACY_NONCE_SIZE:]
         return self.cipher.decrypt(nonce, ciphertext, None)
     
+    def encrypt_stream(self, input_stream, segment_size=SEGMENT_SIZE, salt=None):
+        # A fixed salt is only for replaying the exact same plaintext, e.g.
+        # regenerating parts of an interrupted upload
+        if salt is None:
+            salt = os.urandom(SALT_SIZES[STREAM_VERSION])
+        header = struct.pack(PREAMBLE_FORMAT, STREAM_MAGIC, STREAM_VERSION, segment_size) + salt
+        header, _, stream_cipher = self._parse_header(header)
+        yield header
+        
+        for index, (segment, final) in enumerate(iter_segments(input_stream, segment_size)):
+            yield self._seal_segment(header, stream_cipher, index, segment, final)
+    
+    def decrypt_stream(self, input_stream):
+        preamble = read_exactly(input_stream, PREAMBLE_SIZE)
+        if not self.is_chunked(preamble):
+            yield from self._decrypt_legacy_stream(preamble, input_stream)
+            return
+        
+        version, _ = self._parse_preamble(preamble)
+        header, segment_size, stream_cipher = self._parse_header(preamble + read_exactly(input_stream, SALT_SIZES[version]))
+        sealed_size = segment_size + TAG_SIZE
+        index = 0
+        sealed = read_exactly(input_stream, sealed_size)
+        if not sealed:
+            raise ValueError("Encrypted stream has no segments")
+        while True:
+            next_sealed = read_exactly(input_stream, sealed_size)
+            final = not next_sealed
+            yield self._open_segment(header, stream_cipher, index, sealed, final)
+            if final:
+                break
+            sealed = next_sealed
+            index += 1
+    
+    def _decrypt_legacy_stream(self, head, input_stream, chunk_size=SEGMENT_SIZE):
+        # Single-shot objects carry the tag at the very end, so hold back the
+        # last TAG_SIZE bytes and only check it once the whole body has been read
+        pending = head + read_exactly(input_stream, LEGACY_NONCE_SIZE + TAG_SIZE - len(head))
+        if len(pending) < LEGACY_NONCE_SIZE + TAG_SIZE:
+            raise ValueError("Encrypted data is truncated")
+        nonce = pending[:LEGACY_NONCE_SIZE]
+        pending = pending[LEGACY_NONCE_SIZE:]
+        decryptor = Cipher(algorithms.AES(self.key), modes.GCM(nonce)).decryptor()
+        while chunk := input_stream.read(chunk_size):
+            pending += chunk
+            yield decryptor.update(pending[:-TAG_SIZE])
+            pending = pending[-TAG_SIZE:]
+        yield decryptor.finalize_with_tag(pending)
+    
+    def decrypt_range(self, fetch, object_size, offset, length):
+        # fetch(start, length) returns raw object bytes, e.g. a ranged GET
+        header, segment_size, stream_cipher = self._parse_header(fetch(0, PREAMBLE_SIZE + max(SALT_SIZES.values())))
+        header_size = len(header)
+        sealed_size = segment_size + TAG_SIZE
+        segment_count = max(1, -(-(object_size - header_size) // sealed_size))
+        
+        first = offset // segment_size
+        last = min((offset + max(length, 1) - 1) // segment_size, segment_count - 1)
+        if first > last:
+            return b""
+        start = header_size + first * sealed_size
+        end = min(header_size + (last + 1) * sealed_size, object_size)
+        sealed = fetch(start, end - start)
+        
+        plaintext = []
+        for index in range(first, last + 1):
+            position = (index - first) * sealed_size
+            segment = sealed[position:position + sealed_size]
+            plaintext.append(self._open_segment(header, stream_cipher, index, segment, index == segment_count - 1))
+        skip = offset - first * segment_size
+        return b"".join(plaintext)[skip:skip + length]
+    
     def encrypt_file(self, input_path, output_path=None):
         input_path = Path(input_path)
         
@@ -68,13 +248,9 @@ class EncryptionManager:
         else:
             output_path = Path(output_path)
         
-        with open(input_path, 'rb') as f:
-            plaintext = f.read()
-        
-        encrypted = self.encrypt_data(plaintext)
-        
-        with open(output_path, 'wb') as f:
-            f.write(encrypted)
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            for chunk in self.encrypt_stream(src):
+                dst.write(chunk)
         
         return output_path
     
@@ -89,22 +265,11 @@ class EncryptionManager:
         else:
             output_path = Path(output_path)
         
-        with open(input_path, 'rb') as f:
-            encrypted = f.read()
-        
-        decrypted = self.decrypt_data(encrypted)
-        
-        with open(output_path, 'wb') as f:
-            f.write(decrypted)
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            for chunk in self.decrypt_stream(src):
+                dst.write(chunk)
         
         return output_path
-    
-    def encrypt_stream(self, input_stream):
-        data = input_stream.read()
-        return self.encrypt_data(data)
-    
-    def decrypt_stream(self, encrypted_data):
-        return self.decrypt_data(encrypted_data)
 
 
 def generate_encryption_key(key_file):
@@ -0,0 +1,82 @@
+import sys
+from array import array
+
+# Fields stored in the compact columns below; anything else an entry carries is
+# kept per row in a sparse dict so it can be handed back unchanged.
+CORE_FIELDS = ("local_path", "object_name", "sha256", "size", "encrypted")
+# Per-run flags that describe how an entry was produced, not what it points to
+RUN_FIELDS = ("skipped", "reason")
+
+
+class EntryIndex:
+    
+    def __init__(self):
+        self._rows = {}
+        self._object_names = []
+        self._hashes = bytearray()
+        self._sizes = array("q")
+        self._encrypted = bytearray()
+        self._extras = {}
+    
+    @classmethod
+    def from_entries(cls, entries):
+        index = cls()
+        for entry in entries:
+            index.add(entry)
+        return index
+    
+    def add(self, entry):
+        local_path = entry.get("local_path")
+        if local_path is None:
+            return
+        
+        if local_path in self._rows:
+            # The first entry for a path wins, as it did with the linear scan
+            return
+        
+        row = len(self._object_names)
+        self._rows[sys.intern(local_path)] = row
+        self._object_names.append(None)
+        self._hashes.extend(bytes(32))
+        self._sizes.append(0)
+        self._encrypted.append(0)
+        self._set_row(row, entry)
+    
+    def _set_row(self, row, entry):
+        sha256 = entry.get("sha256") or ""
+        extra = {key: value for key, value in entry.items() if key not in CORE_FIELDS and key not in RUN_FIELDS}
+        try:
+            digest = bytes.fromhex(sha256)
+        except ValueError:
+            digest = b""
+        if len(digest) != 32:
+            # Keep odd hashes verbatim instead of squeezing them into the column
+            digest = bytes(32)
+            extra["sha256"] = sha256
+        
+        self._object_names[row] = entry.get("object_name")
+        self._hashes[row * 32:(row + 1) * 32] = digest
+        self._sizes[row] = entry.get("size", 0) or 0
+        self._encrypted[row] = 1 if entry.get("encrypted", False) else 0
+        if extra:
+            self._extras[row] = extra
+    
+    def get(self, local_path):
+        row = self._rows.get(str(local_path))
+        if row is None:
+            return None
+        entry = {
+            "local_path": str(local_path),
+            "object_name": self._object_names[row],
+            "sha256": self._hashes[row * 32:(row + 1) * 32].hex(),
+            "size": self._sizes[row],
+            "encrypted": bool(self._encrypted[row])
+        }
+        entry.update(self._extras.get(row, {}))
+        return entry
+    
+    def __contains__(self, local_path):
+        return str(local_path) in self._rows
+    
+    def __len__(self):
+        return len(self._rows)
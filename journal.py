@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import threading
+import time
+
+
+class BackupJournal:
+    
+    def __init__(self, path, timestamp, completed=None, fsync_every=100):
+        self.path = path
+        self.timestamp = timestamp
+        self.fsync_every = fsync_every
+        self._completed = completed or {}
+        self._pending_packs = {}
+        self._flushed_packs = set()
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._file = open(path, "a")
+        if os.path.getsize(path) == 0:
+            self._write({"timestamp": timestamp, "started": time.time()})
+            self._sync()
+    
+    @classmethod
+    def open(cls, journal_dir, source_name, timestamp, max_age_hours=24):
+        # An unfinished journal for the source means the last run died mid-way:
+        # continue that snapshot (same timestamp) instead of starting a new one
+        os.makedirs(journal_dir, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", source_name)
+        path = os.path.join(journal_dir, f"{safe_name}.jsonl")
+        
+        header, completed = cls._read(path)
+        if header and time.time() - header.get("started", 0) <= max_age_hours * 3600:
+            print(f"Resuming interrupted backup {header['timestamp']} for {source_name}: {len(completed)} entries already done")
+            return cls(path, header["timestamp"], completed)
+        if header:
+            print(f"Discarding journal of interrupted backup {header['timestamp']} for {source_name}: too old")
+        if os.path.exists(path):
+            os.remove(path)
+        return cls(path, timestamp)
+    
+    @staticmethod
+    def _read(path):
+        if not os.path.exists(path):
+            return None, {}
+        header = None
+        completed = {}
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    break
+                if header is None:
+                    header = record
+                else:
+                    completed[record["local_path"]] = (record["stat"], record["entry"])
+        if header is None or "timestamp" not in header:
+            return None, {}
+        return header, completed
+    
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self._sync()
+    
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+    
+    def _stat_key(self, file_stat):
+        return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+    
+    def lookup(self, path, file_stat):
+        record = self._completed.get(str(path))
+        if record and record[0] == self._stat_key(file_stat):
+            return record[1]
+        return None
+    
+    def record(self, entry, file_stat):
+        line = {"local_path": entry["local_path"], "stat": self._stat_key(file_stat), "entry": entry}
+        with self._lock:
+            # Packed entries only count as done once their pack is in the bucket
+            pack_name = entry["object_name"] if entry.get("storage") == "pack" and not entry.get("skipped") else None
+            if pack_name and pack_name not in self._flushed_packs:
+                self._pending_packs.setdefault(pack_name, []).append(line)
+            else:
+                self._write(line)
+    
+    def pack_flushed(self, pack_name):
+        with self._lock:
+            self._flushed_packs.add(pack_name)
+            for line in self._pending_packs.pop(pack_name, []):
+                self._write(line)
+            self._sync()
+    
+    def complete(self):
+        with self._lock:
+            self._file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+    
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
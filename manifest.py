@@ -0,0 +1,162 @@
+import heapq
+import json
+import tempfile
+import threading
+from contextlib import closing
+
+from compression import is_available, get_compressor, decompress_stream
+
+# Version 1 snapshots keep every entry inline in metadata.json; version 2
+# leaves only a small header there and streams the entries, one JSON object
+# per line sorted by local_path, into a compressed manifest next to it
+MANIFEST_VERSION = 2
+MANIFEST_NAME = "manifest.ndjson"
+
+
+def manifest_key(entry):
+    return entry.get("local_path") or ""
+
+
+class ChunkReader:
+    # File-like read() over an iterable of byte chunks, e.g. ManifestWriter.chunks()
+    # or an encrypted stream, for put_object(length=-1)
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        with memoryview(self._buffer) as view:
+            data = view[:size].tobytes()
+        del self._buffer[:size]
+        return data
+
+
+class ManifestWriter:
+
+    def __init__(self, codec="zlib", level=None, spill_entries=100000, spool_dir=None):
+        self.codec = codec if is_available(codec) else "zlib"
+        self.level = level
+        self.spill_entries = max(1, spill_entries)
+        self.spool_dir = spool_dir
+        self.count = 0
+        self.total_size = 0
+        self.skipped = 0
+        self._buffer = []
+        self._runs = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, manifest_config, compression_config):
+        codec = manifest_config.get("codec", compression_config.get("codec", "zlib"))
+        level = manifest_config.get("level")
+        return cls(codec, level, manifest_config.get("spill_entries", 100000), manifest_config.get("spool_dir"))
+
+    @property
+    def object_name(self):
+        return f"{MANIFEST_NAME}.{self.codec}"
+
+    def header(self):
+        return {"version": MANIFEST_VERSION, "object": self.object_name, "codec": self.codec}
+
+    def append(self, entry):
+        with self._lock:
+            self._buffer.append((manifest_key(entry), json.dumps(entry)))
+            self.count += 1
+            self.total_size += entry.get("size", 0) or 0
+            if entry.get("skipped", False):
+                self.skipped += 1
+            if len(self._buffer) >= self.spill_entries:
+                self._spill()
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def _spill(self):
+        # Memory holds at most spill_entries entries; full buffers go to disk
+        # as sorted runs that are merged when the manifest is written out
+        self._buffer.sort(key=lambda row: row[0])
+        run = tempfile.TemporaryFile(mode="w+", encoding="utf-8", dir=self.spool_dir)
+        for key, line in self._buffer:
+            run.write(json.dumps(key) + "\t" + line + "\n")
+        self._runs.append(run)
+        self._buffer = []
+
+    @staticmethod
+    def _read_run(run):
+        run.seek(0)
+        for row in run:
+            key, line = row.rstrip("\n").split("\t", 1)
+            yield json.loads(key), line
+
+    def lines(self):
+        # heapq.merge is stable, so entries for the same path keep their order
+        self._buffer.sort(key=lambda row: row[0])
+        runs = [self._read_run(run) for run in self._runs] + [iter(self._buffer)]
+        for _, line in heapq.merge(*runs, key=lambda row: row[0]):
+            yield line + "\n"
+
+    def entries(self):
+        for line in self.lines():
+            yield json.loads(line)
+
+    def chunks(self, block_size=1024 * 1024):
+        compressor = get_compressor(self.codec, self.level)
+        pending = bytearray()
+        for line in self.lines():
+            pending += compressor.compress(line.encode("utf-8"))
+            if len(pending) >= block_size:
+                yield bytes(pending)
+                pending.clear()
+        pending += compressor.flush()
+        if pending:
+            yield bytes(pending)
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._buffer = []
+
+
+def manifest_object_name(metadata):
+    return f"{metadata['source_name']}/{metadata['timestamp']}/{metadata['manifest']['object']}"
+
+
+def iter_entries(client, bucket, metadata):
+    if not metadata:
+        return
+    if "manifest" not in metadata:
+        yield from metadata.get("entries", [])
+        return
+
+    response = client.get_object(bucket, manifest_object_name(metadata))
+    try:
+        pending = b""
+        for data in decompress_stream(metadata["manifest"]["codec"], response.stream(1024 * 1024)):
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+        if pending.strip():
+            yield json.loads(pending)
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def find_entry(client, bucket, metadata, predicate):
+    with closing(iter_entries(client, bucket, metadata)) as entries:
+        for entry in entries:
+            if predicate(entry):
+                return entry
+    return None
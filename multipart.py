@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from minio.datatypes import Part
+
+from encryption import read_exactly, SALT_SIZES, STREAM_VERSION
+
+
+# minio has no public API for driving a multipart upload part by part, so
+# every private call goes through these wrappers; requirements.txt pins minio
+# below the next major version, and a signature change only needs fixing here
+def create_upload(client, bucket, object_name):
+    return client._create_multipart_upload(bucket, object_name, {})
+
+
+def upload_part(client, bucket, object_name, upload_id, part_number, data):
+    return client._upload_part(bucket, object_name, data, None, upload_id, part_number)
+
+
+def complete_upload(client, bucket, object_name, upload_id, parts):
+    return client._complete_multipart_upload(bucket, object_name, upload_id, parts)
+
+
+def abort_upload(client, bucket, object_name, upload_id):
+    client._abort_multipart_upload(bucket, object_name, upload_id)
+
+
+def list_uploads(client, bucket, key_marker=None):
+    return client._list_multipart_uploads(bucket, key_marker=key_marker)
+
+
+class ResumeMismatch(Exception):
+    pass
+
+
+class MultipartUploader:
+    
+    def __init__(self, client, state_dir="./upload_state", threshold=256 * 1024 * 1024, part_size=64 * 1024 * 1024, max_workers=4, retries=3, stale_hours=48):
+        self.client = client
+        self.state_dir = state_dir
+        self.threshold = threshold
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.stale_hours = stale_hours
+        self._lock = threading.Lock()
+        os.makedirs(state_dir, exist_ok=True)
+    
+    @classmethod
+    def from_config(cls, client, multipart_config):
+        if not multipart_config.get("enabled", False):
+            return None
+        return cls(
+            client,
+            state_dir=multipart_config.get("state_dir", "./upload_state"),
+            threshold=multipart_config.get("threshold_mb", 256) * 1024 * 1024,
+            part_size=multipart_config.get("part_size_mb", 64) * 1024 * 1024,
+            max_workers=multipart_config.get("max_workers", 4),
+            retries=multipart_config.get("retries", 3),
+            stale_hours=multipart_config.get("stale_hours", 48)
+        )
+    
+    def _checkpoint_path(self, bucket, source_key):
+        # Keyed by what is being uploaded, not by object name, so the next
+        # scheduled run (with a new timestamp prefix) still finds it
+        digest = hashlib.sha256(f"{bucket}\0{source_key}".encode()).hexdigest()
+        return os.path.join(self.state_dir, f"{digest}.json")
+    
+    def _save(self, checkpoint):
+        path = checkpoint["_path"]
+        data = {key: value for key, value in checkpoint.items() if key != "_path"}
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    
+    def _load(self, path):
+        try:
+            with open(path, "r") as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        checkpoint["_path"] = path
+        return checkpoint
+    
+    def _discard(self, checkpoint, abort=True):
+        if abort:
+            try:
+                abort_upload(self.client, checkpoint["bucket"], checkpoint["object_name"], checkpoint["upload_id"])
+            except Exception as e:
+                print(f"Could not abort upload {checkpoint['upload_id']} of {checkpoint['object_name']}: {e}")
+        if os.path.exists(checkpoint["_path"]):
+            os.remove(checkpoint["_path"])
+    
+    def begin(self, bucket, object_name, source_key, fingerprint, part_size=None, encrypted=False):
+        # fingerprint identifies the exact input (stat tuple, codec, ...); a
+        # checkpoint is only resumed when it matches, since resuming replays
+        # the same encryption salt
+        path = self._checkpoint_path(bucket, source_key)
+        checkpoint = self._load(path)
+        if checkpoint:
+            # Checkpoints from before the salted stream format cannot be resumed
+            if checkpoint.get("fingerprint") == fingerprint and checkpoint.get("encrypted") == encrypted and (checkpoint.get("salt") or not encrypted):
+                print(f"Resuming multipart upload of {source_key}: {len(checkpoint['parts'])} part(s) already uploaded")
+                return checkpoint
+            print(f"Discarding outdated multipart upload of {source_key}")
+            self._discard(checkpoint)
+        
+        upload_id = create_upload(self.client, bucket, object_name)
+        checkpoint = {
+            "_path": path,
+            "bucket": bucket,
+            "object_name": object_name,
+            "upload_id": upload_id,
+            "source": source_key,
+            "fingerprint": fingerprint,
+            "encrypted": encrypted,
+            "salt": os.urandom(SALT_SIZES[STREAM_VERSION]).hex() if encrypted else None,
+            "part_size": part_size or self.part_size,
+            "parts": {},
+            "created": time.time()
+        }
+        self._save(checkpoint)
+        return checkpoint
+    
+    def _upload_part(self, checkpoint, part_number, data):
+        etag = upload_part(self.client, checkpoint["bucket"], checkpoint["object_name"], checkpoint["upload_id"], part_number, data)
+        with self._lock:
+            checkpoint["parts"][str(part_number)] = etag
+            self._save(checkpoint)
+        return etag
+    
+    def upload(self, checkpoint, stream):
+        part_size = checkpoint["part_size"]
+        part_number = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            while True:
+                data = read_exactly(stream, part_size)
+                if not data and part_number > 0:
+                    break
+                part_number += 1
+                
+                etag = checkpoint["parts"].get(str(part_number))
+                if etag is not None:
+                    # Parts already in the bucket are regenerated but not sent;
+                    # their ETag (the part's MD5) proves the input is unchanged
+                    if hashlib.md5(data).hexdigest() != etag:
+                        raise ResumeMismatch(f"Part {part_number} of {checkpoint['object_name']} no longer matches the uploaded data")
+                else:
+                    if len(pending) >= self.max_workers:
+                        pending.popleft().result()
+                    pending.append(executor.submit(self._upload_part, checkpoint, part_number, data))
+                if len(data) < part_size:
+                    break
+            while pending:
+                pending.popleft().result()
+        
+        parts = [Part(number, checkpoint["parts"][str(number)]) for number in range(1, part_number + 1)]
+        result = complete_upload(self.client, checkpoint["bucket"], checkpoint["object_name"], checkpoint["upload_id"], parts)
+        self._discard(checkpoint, abort=False)
+        return result
+    
+    def fail(self, checkpoint, error):
+        # A changed input cannot be resumed; anything else keeps the checkpoint
+        if isinstance(error, ResumeMismatch):
+            self._discard(checkpoint)
+    
+    def cleanup_stale(self, bucket):
+        cutoff = time.time() - self.stale_hours * 3600
+        active = set()
+        for name in os.listdir(self.state_dir):
+            if not name.endswith(".json"):
+                continue
+            checkpoint = self._load(os.path.join(self.state_dir, name))
+            if checkpoint is None:
+                continue
+            if checkpoint.get("created", 0) < cutoff:
+                print(f"Aborting stale multipart upload of {checkpoint.get('source')}")
+                self._discard(checkpoint)
+            elif checkpoint.get("bucket") == bucket:
+                active.add(checkpoint.get("upload_id"))
+        
+        # Incomplete uploads in the bucket without a local checkpoint can never
+        # be resumed, drop them once they are old enough
+        key_marker = None
+        while True:
+            result = list_uploads(self.client, bucket, key_marker)
+            for upload in result.uploads:
+                initiated = upload.initiated_time
+                if upload.upload_id in active or initiated is None:
+                    continue
+                if initiated.replace(tzinfo=initiated.tzinfo or timezone.utc) < datetime.fromtimestamp(cutoff, timezone.utc):
+                    print(f"Aborting orphaned multipart upload of {upload.object_name}")
+                    abort_upload(self.client, bucket, upload.object_name, upload.upload_id)
+            if not result.is_truncated or not result.next_key_marker:
+                break
+            key_marker = result.next_key_marker
@@ -0,0 +1,165 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
+
+
+class PackWriter:
+    
+    def __init__(self, client, bucket, dest_prefix, encryption_manager=None, threshold=64 * 1024, pack_size=16 * 1024 * 1024):
+        self.client = client
+        self.bucket = bucket
+        self.dest_prefix = dest_prefix
+        self.encryption_manager = encryption_manager
+        self.threshold = threshold
+        self.pack_size = pack_size
+        self.packs_written = 0
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._pack_number = 0
+        self._pack_name = None
+        self._error = None
+        # Unique per writer so a resumed snapshot never overwrites packs that
+        # entries from the interrupted run already point into
+        self._writer_id = os.urandom(4).hex()
+        self.on_flush = None
+    
+    @classmethod
+    def from_config(cls, client, bucket, dest_prefix, encryption_manager, packing_config):
+        if not packing_config.get("enabled", False):
+            return None
+        return cls(
+            client,
+            bucket,
+            dest_prefix,
+            encryption_manager,
+            threshold=packing_config.get("threshold_kb", 64) * 1024,
+            pack_size=packing_config.get("pack_size_mb", 16) * 1024 * 1024
+        )
+    
+    def accepts(self, size):
+        # Empty files would get a zero-length slot, and a pack holding only
+        # those is never uploaded
+        return 0 < size < self.threshold
+    
+    def _next_pack_name(self):
+        self._pack_number += 1
+        return f"{self.dest_prefix}/packs/pack-{self._writer_id}-{self._pack_number:05d}.pack"
+    
+    def _flush(self, pack_name, data):
+        try:
+            self.client.put_object(self.bucket, pack_name, data=BytesIO(data), length=len(data))
+        except Exception as e:
+            # Entries already handed out point into this pack, so the whole
+            # source has to fail rather than just the file that triggered it
+            self._error = e
+            raise
+        self.packs_written += 1
+        print(f"Uploaded pack: {pack_name} ({len(data)} bytes)")
+        if self.on_flush:
+            self.on_flush(pack_name)
+    
+    def add(self, data):
+        if self.encryption_manager:
+            data = self.encryption_manager.encrypt_data(data)
+        
+        full = None
+        with self._lock:
+            if self._error:
+                raise Exception(f"Pack upload failed earlier: {self._error}")
+            if self._buffer and len(self._buffer) + len(data) > self.pack_size:
+                full = (self._pack_name, bytes(self._buffer))
+                self._buffer.clear()
+                self._pack_name = None
+            if self._pack_name is None:
+                self._pack_name = self._next_pack_name()
+            pack_name = self._pack_name
+            offset = len(self._buffer)
+            self._buffer += data
+        
+        if full:
+            self._flush(*full)
+        return pack_name, offset, len(data)
+    
+    def close(self):
+        with self._lock:
+            pending = (self._pack_name, bytes(self._buffer)) if self._buffer else None
+            self._buffer.clear()
+            self._pack_name = None
+        if pending:
+            self._flush(*pending)
+        if self._error:
+            raise Exception(f"Pack upload failed: {self._error}")
+
+
+class PackReader:
+    
+    def __init__(self, client, bucket, whole_pack_min_entries=4, cache_size=2):
+        self.client = client
+        self.bucket = bucket
+        self.whole_pack_min_entries = whole_pack_min_entries
+        self.cache_size = cache_size
+        self._entry_counts = {}
+        self._cache = OrderedDict()
+        self._fetching = {}
+        self._lock = threading.Lock()
+    
+    def plan(self, entries):
+        # Packs that many entries will be restored from are fetched once and
+        # split locally, the rest are read with ranged GETs
+        for entry in entries:
+            if entry.get("storage") == "pack":
+                pack_name = entry["object_name"]
+                self._entry_counts[pack_name] = self._entry_counts.get(pack_name, 0) + 1
+    
+    def _get(self, pack_name, offset=0, length=0):
+        response = self.client.get_object(self.bucket, pack_name, offset=offset, length=length)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+    
+    def _whole_pack(self, pack_name):
+        # The first reader of a pack downloads it, readers arriving meanwhile
+        # wait on its future instead of starting downloads of their own
+        with self._lock:
+            if pack_name in self._cache:
+                self._cache.move_to_end(pack_name)
+                return self._cache[pack_name]
+            future = self._fetching.get(pack_name)
+            owner = future is None
+            if owner:
+                future = self._fetching[pack_name] = Future()
+        if not owner:
+            return future.result()
+        try:
+            data = self._get(pack_name)
+        except Exception as e:
+            with self._lock:
+                del self._fetching[pack_name]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._fetching[pack_name]
+            self._cache[pack_name] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        future.set_result(data)
+        return data
+    
+    def read(self, entry):
+        pack_name = entry["object_name"]
+        offset = entry["offset"]
+        length = entry["length"]
+        if length == 0:
+            # get_object treats length=0 as "to the end of the object"
+            return b""
+        if self._entry_counts.get(pack_name, 0) >= self.whole_pack_min_entries:
+            data = self._whole_pack(pack_name)[offset:offset + length]
+        else:
+            data = self._get(pack_name, offset, length)
+        if len(data) != length:
+            raise ValueError(f"Short read from pack {pack_name}: {len(data)} of {length} bytes")
+        return data
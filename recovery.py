@@ -8,7 +8,21 @@ from minio import Minio
 import shutil
 import subprocess
 import sys
+import tempfile
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from encryption import EncryptionManager
+from chunk_store import ChunkStore, CHUNK_PREFIX
+from pack_store import PackReader
+from snapshot_index import read_index, snapshot_timestamps, list_snapshot_timestamps
+from compression import decompress_bytes, decompress_stream
+from db_incremental import reload_tables
+from db_cluster import cluster_db_config, ensure_database, globals_path, maintenance_config
+from wal_archive import WAL_PREFIX, prefetch_segments
+from stat_cache import StatCache
+from catalog import Catalog
+from manifest import iter_entries, find_entry
 
 client = Minio(
     "localhost:9000",
@@ -19,6 +33,9 @@ client = Minio(
 
 temp_path_prefix = "/tmp/recovery"
 encryption_manager = None
+delta_restore = False
+stat_cache = None
+catalog = None
 
 def load_config(path="config.json"):
     with open(path, "r") as f:
@@ -41,12 +58,14 @@ def get_date_from_backup_name(backup_name, prefix):
     return datetime.strptime(date_string, date_format)
 
 def get_available_sources(bucket):
-    sources = set()
+    # The catalog may miss sources first backed up from another host, so the
+    # top-level listing is always merged in
+    sources = set(catalog.sources()) if catalog else set()
     try:
         objects = client.list_objects(bucket, recursive=False)
         for obj in objects:
             source_name = obj.object_name.rstrip('/')
-            if source_name:
+            if source_name and source_name not in (CHUNK_PREFIX, WAL_PREFIX):
                 sources.add(source_name)
     except Exception as e:
         print(f"Error listing sources: {e}")
@@ -77,76 +96,117 @@ def get_metadata_file(latest_backup, client, bucket):
             break
     return metadata
 
-def check_hash(file_path, expected_hash, chunk_size=65536):
+def get_latest_metadata(client, bucket, source_name):
+    index = read_index(client, bucket, source_name)
+    if catalog:
+        latest = catalog.latest_snapshot(source_name)
+        # A catalog behind the snapshot index would restore a stale snapshot
+        if latest and not (index and index.get("latest", "") > latest):
+            print(f"\nAvailable backups for '{source_name}': {len(catalog.snapshots(source_name))} (latest {latest}, from catalog)")
+            print(f"\nLatest backup: {source_name}/{latest}/")
+            return catalog.load_metadata(source_name, latest)
+
+    if index and index.get("latest"):
+        timestamps = snapshot_timestamps(index)
+        print(f"\nAvailable backups for '{source_name}': {len(timestamps)} (latest {index['latest']})")
+        try:
+            metadata_data = client.get_object(bucket, f"{source_name}/{index['latest']}/metadata.json")
+            print(f"\nLatest backup: {source_name}/{index['latest']}/")
+            return json.loads(metadata_data.read().decode('utf-8'))
+        except Exception as e:
+            print(f"Snapshot index for '{source_name}' is stale, listing backups: {e}")
+
+    objects = (obj for obj in client.list_objects(bucket, prefix=source_name + "/", recursive=False) if obj.is_dir)
+    latest_backup = get_latest_backup(objects, source_name)
+    if latest_backup is None:
+        print(f"No backups found for source '{source_name}'.")
+        return None
+
+    print(f"\nLatest backup: {latest_backup.object_name}")
+    return get_metadata_file(latest_backup, client, bucket)
+
+def sha256_file(file_path, chunk_size=1024 * 1024):
     sha = hashlib.sha256()
     with file_path.open("rb") as f:
         while chunk := f.read(chunk_size):
             sha.update(chunk)
-    return sha.hexdigest() == expected_hash
+    return sha.hexdigest()
 
-def recover_db(client, entry, bucket):
-    db_name = entry.get('db_name', 'unknown')
+def check_hash(file_path, expected_hash):
+    return sha256_file(file_path) == expected_hash
 
-    db_config = None
-    for source in config.get("backup_sources", []):
-        if source.get("type") == "database" and source.get("db_config", {}).get("dbname") == db_name:
-            db_config = source["db_config"]
-            break
-    
-    if not db_config:
-        print(f"Error: No database configuration found for '{db_name}'")
+def local_file_matches(entry):
+    # A file of the right size is hashed (or its hash taken from the stat
+    # cache when the stat tuple is unchanged) before deciding to download
+    local_path = Path(entry['local_path'])
+    try:
+        file_stat = local_path.stat()
+    except FileNotFoundError:
         return False
-    
-    db_temp_path = db_config["db_temp_path"]
-    os.makedirs(os.path.dirname(db_temp_path), exist_ok=True)
-    
-    object_name = entry['object_name']
-    is_encrypted = entry.get('encrypted', False)
-    
-    if is_encrypted:
-        encrypted_temp = db_temp_path + '.enc'
-        client.fget_object(bucket, object_name, encrypted_temp)
-        
-        if encryption_manager:
-            try:
-                encryption_manager.decrypt_file(encrypted_temp, db_temp_path)
-                os.remove(encrypted_temp)
-                print(f"  Downloaded and decrypted database dump.")
-            except Exception as e:
-                print(f"  Error decrypting database dump: {e}")
-                return False
+    if file_stat.st_size != entry.get('size'):
+        return False
+    file_hash = stat_cache.lookup(local_path, file_stat) if stat_cache else None
+    if file_hash is None:
+        file_hash = sha256_file(local_path)
+        if stat_cache:
+            stat_cache.store(local_path, file_stat, file_hash)
+    return file_hash == entry['sha256']
+
+def iter_object_data(client, bucket, entry):
+    response = client.get_object(bucket, entry['object_name'])
+    try:
+        if entry.get('encrypted', False):
+            chunks = encryption_manager.decrypt_stream(response)
         else:
-            print(f"  Error: Database dump is encrypted but no encryption key available")
-            return False
-    else:
-        client.fget_object(bucket, object_name, db_temp_path)
-        print(f"  Downloaded database dump to temporary path.")
-    
-    if not check_hash(Path(db_temp_path), entry['sha256']):
+            chunks = response.stream(1024 * 1024)
+        if entry.get('codec'):
+            chunks = decompress_stream(entry['codec'], chunks)
+        yield from chunks
+    finally:
+        response.close()
+        response.release_conn()
+
+def fetch_dump_file(client, bucket, entry, target_path):
+    sha = hashlib.sha256()
+    with open(target_path, "wb") as f:
+        for data in iter_object_data(client, bucket, entry):
+            sha.update(data)
+            f.write(data)
+    if sha.hexdigest() != entry['sha256']:
         print(f"  Hash doesn't match for {entry['object_name']}, database dump may be corrupted.")
         return False
-    
-    print(f"  Restoring database '{db_name}' from dump...")
-    
+    return True
+
+def is_delta(entry):
+    return entry.get('backup_mode') == 'incremental'
+
+def pg_restore_command(db_config, dump_format, jobs=1, source=None):
     command = [
         "pg_restore",
         "-U", db_config["user"],
         "-h", db_config["host"],
         "-p", db_config["port"],
-        "-Fc",
-        "--clean",
-        "--if-exists",
+        "-F" + dump_format,
         "-d", db_config["dbname"],
-        db_temp_path
+        "--clean", "--if-exists"
     ]
-    
+    if jobs > 1:
+        command += ["-j", str(jobs)]
+    if source:
+        command.append(source)
+    else:
+        # Reading from stdin; stream_pg_restore holds back the end of the
+        # archive until its hash is verified, so a bad dump is rolled back
+        command.append("--single-transaction")
+    return command
+
+def run_pg_restore(command, db_config):
+    db_name = db_config["dbname"]
     try:
         env = os.environ.copy()
         env["PGPASSWORD"] = db_config["password"]
-        result = subprocess.run(command, check=True, env=env, capture_output=True, text=True)
+        subprocess.run(command, check=True, env=env, capture_output=True, text=True)
         print(f"  Database '{db_name}' has been successfully restored.")
-        if os.path.exists(db_temp_path):
-            os.remove(db_temp_path)
         return True
     except subprocess.CalledProcessError as e:
         print(f"  Error occurred while restoring the database: {e}")
@@ -158,64 +218,517 @@ def recover_db(client, entry, bucket):
         print("  On macOS, you can install it with: brew install postgresql")
         return False
 
-def recover_file(client, entry, bucket):
-    global encryption_manager
+def stream_pg_restore(client, entry, bucket, db_config, holdback=1024 * 1024):
+    # Single-job restores read the archive from stdin, so the dump is never
+    # written to db_temp_path. pg_restore cannot reach the end of the archive
+    # and commit while its last bytes are held back, and those are only
+    # written once the hash of the whole dump matches.
+    db_name = db_config["dbname"]
+    env = os.environ.copy()
+    env["PGPASSWORD"] = db_config["password"]
+    with tempfile.TemporaryFile() as output:
+        try:
+            process = subprocess.Popen(pg_restore_command(db_config, "c"), stdin=subprocess.PIPE, stdout=output, stderr=output, env=env)
+        except FileNotFoundError:
+            print("  Error: pg_restore command not found. Please install PostgreSQL client tools.")
+            print("  On macOS, you can install it with: brew install postgresql")
+            return False
+        
+        sha = hashlib.sha256()
+        held = b""
+        try:
+            for data in iter_object_data(client, bucket, entry):
+                sha.update(data)
+                held += data
+                if len(held) > holdback:
+                    process.stdin.write(held[:-holdback])
+                    held = held[-holdback:]
+            if sha.hexdigest() != entry['sha256']:
+                raise ValueError("hash doesn't match, database dump may be corrupted")
+            process.stdin.write(held)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            process.kill()
+            process.wait()
+            print(f"  Error streaming {entry['object_name']} into pg_restore: {e}")
+            return False
+        
+        if process.wait() != 0:
+            output.seek(0)
+            print(f"  Error occurred while restoring the database: pg_restore exited with code {process.returncode}")
+            print(f"  OUTPUT: {output.read().decode('utf-8', errors='replace')}")
+            return False
+    print(f"  Database '{db_name}' has been successfully restored.")
+    return True
+
+def fetch_dump_directory(client, bucket, entry, dump_dir, jobs):
+    shutil.rmtree(dump_dir, ignore_errors=True)
+    dump_dir.mkdir(parents=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        fetched = list(executor.map(
+            lambda file_entry: fetch_dump_file(client, bucket, file_entry, dump_dir / file_entry['name']),
+            entry['files']
+        ))
+    if all(fetched):
+        print(f"  Downloaded {len(fetched)} dump files")
+    return all(fetched)
+
+def restore_db_directory(client, entry, bucket, db_config, jobs):
+    dump_dir = Path(db_config["db_temp_path"] + ".d")
+    try:
+        if not fetch_dump_directory(client, bucket, entry, dump_dir, jobs):
+            return False
+        print(f"  Restoring with {jobs} job(s)...")
+        return run_pg_restore(pg_restore_command(db_config, "d", jobs, str(dump_dir)), db_config)
+    finally:
+        shutil.rmtree(dump_dir, ignore_errors=True)
+
+def restore_db_delta(client, entry, bucket, db_config, jobs):
+    # The delta is downloaded and its hash checked before the database is
+    # touched; emptying the changed tables and reloading them is then a single
+    # transaction, so a bad or failing delta leaves the database as it was
+    db_name = db_config["dbname"]
+    directory = entry.get('format') == 'directory'
+    dump_path = Path(db_config["db_temp_path"] + (".d" if directory else ""))
+    dump_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if directory:
+            fetched = fetch_dump_directory(client, bucket, entry, dump_path, jobs)
+        else:
+            fetched = fetch_dump_file(client, bucket, entry, dump_path)
+        if not fetched:
+            return False
+        script_command = ["pg_restore", "-F" + ("d" if directory else "c"), "--data-only", "--disable-triggers", "-f", "-", str(dump_path)]
+        reload_tables(db_config, entry['changed_tables'], script_command)
+    except FileNotFoundError as e:
+        print(f"  Error: {e.filename} command not found. Please install PostgreSQL client tools.")
+        return False
+    except Exception as e:
+        print(f"  Error applying incremental backup {entry['object_name']} to '{db_name}': {e}")
+        return False
+    finally:
+        if directory:
+            shutil.rmtree(dump_path, ignore_errors=True)
+        elif dump_path.exists():
+            dump_path.unlink()
+    print(f"  Database '{db_name}' has been successfully restored.")
+    return True
+
+def load_db_chain(client, bucket, entry):
+    # Walks an incremental entry back to its full dump; returned oldest first
+    source_name = entry['object_name'].split('/')[0]
+    chain = [entry]
+    while is_delta(chain[0]):
+        if len(chain) > entry.get('chain_length', 0) + 1:
+            raise Exception(f"incremental chain of '{entry['db_name']}' does not end in a full backup")
+        parent = chain[0]['parent']
+        metadata_data = client.get_object(bucket, f"{source_name}/{parent}/metadata.json")
+        metadata = json.loads(metadata_data.read().decode('utf-8'))
+        parent_entry = find_entry(client, bucket, metadata, lambda e: e.get('db_name') == entry['db_name'])
+        if parent_entry is None:
+            raise Exception(f"snapshot {parent} has no dump of '{entry['db_name']}'")
+        chain.insert(0, parent_entry)
+    return chain
+
+def restore_db_entry(client, entry, bucket, db_config):
+    jobs = max(db_config.get("jobs", 1), 1)
+    if is_delta(entry):
+        return restore_db_delta(client, entry, bucket, db_config, jobs)
+    if entry.get('format') == 'directory':
+        return restore_db_directory(client, entry, bucket, db_config, jobs)
+    if jobs == 1:
+        return stream_pg_restore(client, entry, bucket, db_config)
     
-    temp_path = Path(f"{temp_path_prefix}/{entry['local_path']}")
-    temp_path.parent.mkdir(parents=True, exist_ok=True)
+    # pg_restore -j needs a seekable archive
+    db_temp_path = db_config["db_temp_path"]
+    os.makedirs(os.path.dirname(db_temp_path), exist_ok=True)
+    try:
+        if not fetch_dump_file(client, bucket, entry, db_temp_path):
+            return False
+        print(f"  Downloaded database dump to temporary path.")
+        return run_pg_restore(pg_restore_command(db_config, "c", jobs, db_temp_path), db_config)
+    finally:
+        if os.path.exists(db_temp_path):
+            os.remove(db_temp_path)
+
+def find_cluster_config(entry):
+    source_name = entry['object_name'].split('/')[0]
+    for source in config.get("backup_sources", []):
+        if source.get("type") == "database_cluster" and source.get("name") == source_name:
+            return source["cluster_config"]
+    return None
+
+def recover_globals(client, entry, bucket):
+    cluster_config = find_cluster_config(entry)
+    if not cluster_config:
+        print(f"Error: No cluster configuration found for '{entry['object_name']}'")
+        return False
+    if entry.get('encrypted', False) and not encryption_manager:
+        print(f"  Error: Globals dump is encrypted but no encryption key available")
+        return False
     
-    object_name = entry['object_name']
-    is_encrypted = entry.get('encrypted', False)
+    path = globals_path(cluster_config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    maintenance = maintenance_config(cluster_config)
+    command = [
+        "psql",
+        "-U", maintenance["user"],
+        "-h", maintenance["host"],
+        "-p", maintenance["port"],
+        "-d", maintenance["dbname"],
+        "-f", path
+    ]
+    try:
+        if not fetch_dump_file(client, bucket, entry, path):
+            return False
+        env = os.environ.copy()
+        env["PGPASSWORD"] = maintenance["password"]
+        # Without ON_ERROR_STOP, roles that already exist are reported and skipped
+        result = subprocess.run(command, check=True, env=env, capture_output=True, text=True)
+        for line in result.stderr.splitlines():
+            print(f"  Warning: {line}")
+        print(f"  Roles and tablespaces have been restored.")
+        return True
+    except Exception as e:
+        print(f"  Error restoring roles and tablespaces: {e}")
+        return False
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def find_wal_source(entry):
+    source_name = entry['object_name'].split('/')[0]
+    for source in config.get("backup_sources", []):
+        if source.get("type") == "database_wal" and source.get("name") == source_name:
+            return source
+    return None
+
+def recover_basebackup(client, entry, bucket, target_time=None, wal_end=None):
+    # Lays out a data directory from the base backup and prefetched WAL; the
+    # server then replays up to target_time (or the end of the archive) on start
+    source = find_wal_source(entry)
+    if not source:
+        print(f"Error: No WAL archiving configuration found for '{entry['object_name']}'")
+        return False
+    if entry.get('encrypted', False) and not encryption_manager:
+        print(f"  Error: Base backup is encrypted but no encryption key available")
+        return False
     
-    if is_encrypted:
-        encrypted_temp = temp_path.with_suffix(temp_path.suffix + '.enc')
-        client.fget_object(bucket, object_name, str(encrypted_temp))
+    wal_config = source["wal_config"]
+    data_dir = Path(wal_config["restore_data_dir"])
+    if data_dir.exists() and any(data_dir.iterdir()):
+        print(f"  Error: {data_dir} is not empty, refusing to restore over it")
+        return False
+    workers = wal_config.get("restore_workers", 8)
+    staging_dir = Path(f"{temp_path_prefix}/{source['name']}-base")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = list(executor.map(
+                lambda file_entry: fetch_dump_file(client, bucket, file_entry, staging_dir / file_entry['name']),
+                entry['files']
+            ))
+        if not all(fetched):
+            return False
+        
+        data_dir.mkdir(parents=True, exist_ok=True)
+        os.chmod(data_dir, 0o700)
+        for file_entry in entry['files']:
+            if file_entry['name'] == 'base.tar':
+                target_dir = data_dir
+            elif file_entry['name'] == 'pg_wal.tar':
+                target_dir = data_dir / 'pg_wal'
+            elif file_entry['name'].endswith('.tar'):
+                print(f"  Warning: tablespace archive {file_entry['name']} must be extracted to its tablespace location by hand")
+                continue
+            else:
+                continue
+            # base.tar holds the absolute pg_tblspc/* symlinks, which the
+            # "data" filter refuses; "tar" still keeps members inside target_dir
+            with tarfile.open(staging_dir / file_entry['name']) as tar:
+                tar.extractall(target_dir, filter="tar" if file_entry['name'] == 'base.tar' else "data")
+        
+        spool_dir = f"{data_dir}.wal"
+        count = prefetch_segments(client, bucket, source['name'], spool_dir, entry['wal_start'], wal_end, encryption_manager, workers)
+        print(f"  Prefetched {count} WAL file(s) into {spool_dir}")
         
-        if encryption_manager:
-            try:
-                encryption_manager.decrypt_file(encrypted_temp, temp_path)
-                encrypted_temp.unlink()
-                print(f"  Decrypted: {object_name}")
-            except Exception as e:
-                print(f"  Error decrypting {object_name}: {e}")
+        settings = [f"restore_command = 'cp \"{spool_dir}/%f\" \"%p\"'"]
+        if target_time:
+            settings.append(f"recovery_target_time = '{target_time}'")
+            settings.append("recovery_target_action = 'promote'")
+        with open(data_dir / "postgresql.auto.conf", "a") as f:
+            f.write("\n".join(settings) + "\n")
+        (data_dir / "recovery.signal").touch()
+        print(f"  Data directory ready: start PostgreSQL on {data_dir} to replay WAL{' up to ' + target_time if target_time else ''}.")
+        return True
+    except Exception as e:
+        print(f"  Error restoring base backup: {e}")
+        return False
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def run_pitr(source_name, target_time):
+    config = load_config()
+    bucket = config["bucket"]
+    target = datetime.strptime(target_time, "%Y-%m-%d %H:%M:%S")
+    
+    index = read_index(client, bucket, source_name)
+    timestamps = snapshot_timestamps(index) if index else list_snapshot_timestamps(client, bucket, source_name)
+    earlier = [ts for ts in timestamps if datetime.strptime(ts, "%Y-%m-%d_%H-%M-%S") <= target]
+    later = [ts for ts in timestamps if datetime.strptime(ts, "%Y-%m-%d_%H-%M-%S") > target]
+    if not earlier:
+        print(f"No base backup of '{source_name}' was taken before {target_time}.")
+        return False
+    
+    def base_entry(timestamp):
+        metadata_data = client.get_object(bucket, f"{source_name}/{timestamp}/metadata.json")
+        metadata = json.loads(metadata_data.read().decode('utf-8'))
+        return find_entry(client, bucket, metadata, lambda e: e.get('format') == 'basebackup')
+    
+    # WAL past the next base backup's start is never needed to reach the target
+    entry = base_entry(earlier[-1])
+    if entry is None:
+        print(f"Error: snapshot {source_name}/{earlier[-1]} has no base backup to restore from.")
+        return False
+    next_entry = base_entry(later[0]) if later else None
+    wal_end = next_entry.get('wal_start') if next_entry else None
+    print(f"Restoring '{source_name}' from base backup {earlier[-1]} to {target_time}")
+    return recover_basebackup(client, entry, bucket, target_time, wal_end)
+
+def recover_db(client, entry, bucket):
+    db_name = entry.get('db_name', 'unknown')
+
+    db_config = None
+    cluster_config = find_cluster_config(entry)
+    if cluster_config:
+        db_config = cluster_db_config(cluster_config, db_name)
+    else:
+        for source in config.get("backup_sources", []):
+            if source.get("type") == "database" and source.get("db_config", {}).get("dbname") == db_name:
+                db_config = source["db_config"]
+                break
+    
+    if not db_config:
+        print(f"Error: No database configuration found for '{db_name}'")
+        return False
+    
+    if entry.get('encrypted', False) and not encryption_manager:
+        print(f"  Error: Database dump is encrypted but no encryption key available")
+        return False
+    
+    print(f"  Restoring database '{db_name}' from dump...")
+    try:
+        if cluster_config:
+            ensure_database(cluster_config, db_name)
+        chain = load_db_chain(client, bucket, entry)
+        if len(chain) > 1:
+            print(f"  Rebuilding from {chain[0]['object_name']} plus {len(chain) - 1} incremental backup(s)")
+        for link in chain:
+            if not restore_db_entry(client, link, bucket, db_config):
                 return False
-        else:
-            print(f"  Error: File is encrypted but no encryption key available")
+        return True
+    except Exception as e:
+        print(f"  Error restoring database '{db_name}': {e}")
+        return False
+
+# mkstemp creates files as 0600; restored files get the mode a plain open()
+# would give them. Read once at import, os.umask is not thread-safe.
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+class VerifiedFileWriter:
+    # Restores into a temp file beside the destination, so the final rename is
+    # atomic and a bad download never replaces what is already there. The temp
+    # name is unique, entries restoring to the same path run concurrently.
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.temp_path = None
+        self.sha = hashlib.sha256()
+        self._file = None
+    
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+        self.temp_path = Path(temp_name)
+        os.fchmod(fd, FILE_MODE)
+        self._file = os.fdopen(fd, "wb")
+        return self
+    
+    def write(self, data):
+        self.sha.update(data)
+        self._file.write(data)
+    
+    def commit(self, expected_hash):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if self.sha.hexdigest() != expected_hash:
             return False
-    else:
-        client.fget_object(bucket, object_name, str(temp_path))
+        os.replace(self.temp_path, self.path)
+        dir_fd = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return True
+    
+    def __exit__(self, exc_type, exc, traceback):
+        if not self._file.closed:
+            self._file.close()
+        if self.temp_path.exists():
+            self.temp_path.unlink()
+
+def recover_file(client, entry, bucket, pack_reader=None):
+    global encryption_manager
     
-    if not check_hash(temp_path, entry['sha256']):
-        print(f"  Hash doesn't match for {entry['object_name']}, file may be corrupted.")
+    object_name = entry['object_name']
+    is_encrypted = entry.get('encrypted', False)
+    if delta_restore and local_file_matches(entry):
+        print(f"  Unchanged, skipped: {entry['local_path']}")
+        return True
+    if is_encrypted and not encryption_manager:
+        print(f"  Error: File is encrypted but no encryption key available")
+        return False
+    
+    # Every storage layout is read once, decrypted and decompressed on the fly
+    # and hashed while it is written
+    try:
+        with VerifiedFileWriter(Path(entry['local_path'])) as writer:
+            if entry.get('storage') == 'chunks':
+                chunk_store = ChunkStore(client, bucket, encryption_manager)
+                chunk_store.restore_stream(entry['chunks'], writer, is_encrypted)
+                print(f"  Reassembled from {len(entry['chunks'])} chunks: {object_name}")
+            elif entry.get('storage') == 'pack':
+                reader = pack_reader or PackReader(client, bucket)
+                data = reader.read(entry)
+                if is_encrypted:
+                    data = encryption_manager.decrypt_data(data)
+                if entry.get('codec'):
+                    data = decompress_bytes(data, entry['codec'])
+                writer.write(data)
+                print(f"  Unpacked from {object_name}")
+            else:
+                for data in iter_object_data(client, bucket, entry):
+                    writer.write(data)
+                if is_encrypted:
+                    print(f"  Decrypted: {object_name}")
+            
+            if not writer.commit(entry['sha256']):
+                print(f"  Hash doesn't match for {entry['object_name']}, file may be corrupted.")
+                return False
+        if stat_cache:
+            stat_cache.store(writer.path, writer.path.stat(), entry['sha256'])
+    except Exception as e:
+        # InvalidTag (tampered or truncated ciphertext) carries no message
+        print(f"  Error restoring {entry['local_path']} from {object_name}: {str(e) or type(e).__name__}")
         return False
-    local_path = Path(entry['local_path'])
-    local_path.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy(temp_path, local_path)
     return True
 
-def retrieve_files(metadata, client, bucket):
+def recover_entry(client, entry, bucket, source_type, pack_reader=None):
+    print(f"  Retrieving: {entry['object_name']}")
+    try:
+        if entry.get('format') == 'basebackup':
+            return recover_basebackup(client, entry, bucket)
+        if entry.get('globals'):
+            return recover_globals(client, entry, bucket)
+        if source_type in ("database", "database_cluster") or entry['object_name'].endswith('db_backup.dump'):
+            return recover_db(client, entry, bucket)
+        return recover_file(client, entry, bucket, pack_reader)
+    except Exception as e:
+        print(f"  Error retrieving {entry['object_name']}: {e}")
+        return False
+
+def retrieve_files(metadata, client, bucket, max_workers=1):
     retrieved = 0
-    entries = metadata.get("entries", [])
-    total = len(entries)
+    failed = []
+    total = 0
     source_type = metadata.get("source_type", "unknown")
+    pack_reader = PackReader(client, bucket)
     
-    for entry in entries:
-        print(f"  Retrieving: {entry['object_name']}")
-        if source_type == "database" or entry['object_name'].endswith('db_backup.dump'):
-            if recover_db(client, entry, bucket):
-                retrieved += 1
+    def collect(entry, succeeded):
+        nonlocal retrieved
+        if succeeded:
+            retrieved += 1
         else:
-            if recover_file(client, entry, bucket):
-                retrieved += 1
+            failed.append(entry['object_name'])
+    
+    # The manifest is streamed twice rather than held in memory: once to plan
+    # pack reads and restore roles, which have to exist before any database
+    # is restored into, and once for everything else
+    globals_entries = []
+    for entry in iter_entries(client, bucket, metadata):
+        total += 1
+        pack_reader.plan([entry])
+        if entry.get('globals'):
+            globals_entries.append(entry)
+    for entry in globals_entries:
+        collect(entry, recover_entry(client, entry, bucket, source_type, pack_reader))
     
-    if os.path.exists(temp_path_prefix):
-        shutil.rmtree(temp_path_prefix)
+    # Same bounded window as the backup side: at most max_workers restores
+    # running with as many queued, however many entries the snapshot has
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = deque()
+        for entry in iter_entries(client, bucket, metadata):
+            if entry.get('globals'):
+                continue
+            if len(pending) >= 2 * max_workers:
+                done_entry, future = pending.popleft()
+                collect(done_entry, future.result())
+            pending.append((entry, executor.submit(recover_entry, client, entry, bucket, source_type, pack_reader)))
+        while pending:
+            done_entry, future = pending.popleft()
+            collect(done_entry, future.result())
+    
+    for object_name in failed[:10]:
+        print(f"  Failed: {object_name}")
+    if len(failed) > 10:
+        print(f"  ... and {len(failed) - 10} more")
+    return (retrieved, total)
+
+def recover_source(client, bucket, source_name, max_workers=1):
+    print(f"\n{'='*60}")
+    print(f"=== Recovering source: {source_name} ===")
+    print(f"{'='*60}")
+    
+    metadata = get_latest_metadata(client, bucket, source_name)
+    if metadata is None:
+        print("No metadata found in the latest backup.")
+        return (0, 0)
+    
+    print(f"Source type: {metadata.get('source_type', 'unknown')}")
+    print(f"Timestamp: {metadata.get('timestamp', 'unknown')}")
+    print(f"Total files: {metadata.get('files_count', len(metadata.get('entries', [])))}")
+    
+    (retrieved, total) = retrieve_files(metadata, client, bucket, max_workers)
+    
+    print(f"\n=== Recovery completed for '{source_name}': Retrieved {retrieved}/{total} files ===")
     return (retrieved, total)
 
 
-def run_recovery(source_filter=None):
+def run_recovery(source_filter=None, recover_all=False):
+    global delta_restore, stat_cache, catalog
+    
     config = load_config()
     bucket = config["bucket"]
+    recovery_config = config.get("recovery", {})
+    max_workers = recovery_config.get("max_workers", 8)
+    delta_restore = recovery_config.get("delta", False)
+
+    catalog = Catalog.from_config(config.get("catalog", {}))
+    if catalog:
+        # Picks up snapshots written from other hosts; only snapshots missing
+        # from the catalog are downloaded
+        try:
+            added, removed = catalog.sync(client, bucket)
+            if added or removed:
+                print(f"Catalog synced: {added} snapshot(s) added, {removed} removed")
+        except Exception as e:
+            print(f"Warning: could not sync the catalog, falling back to the bucket where it is behind: {e}")
 
     available_sources = get_available_sources(bucket)
     
@@ -227,12 +740,16 @@ def run_recovery(source_filter=None):
     for i, source in enumerate(available_sources, 1):
         print(f"{i}. {source}")
     
-    if source_filter:
-        if source_filter not in available_sources:
-            print(f"\nError: Source '{source_filter}' not found.")
+    if recover_all:
+        selected_sources = available_sources
+    elif source_filter:
+        requested = [source_filter] if isinstance(source_filter, str) else list(source_filter)
+        missing = [name for name in requested if name not in available_sources]
+        if missing:
+            print(f"\nError: Source '{missing[0]}' not found.")
             print(f"Available sources: {', '.join(available_sources)}")
             return
-        selected_sources = [source_filter]
+        selected_sources = requested
     else:
         print("\nOptions:")
         print("  - Enter source number (1, 2, ...)")
@@ -256,33 +773,35 @@ def run_recovery(source_filter=None):
             print(f"Invalid choice. Please enter a number (1-{len(available_sources)}), 'all', or a source name.")
             return
 
-    for source_name in selected_sources:
-        print(f"\n{'='*60}")
-        print(f"=== Recovering source: {source_name} ===")
-        print(f"{'='*60}")
-        
-        objects = client.list_objects(bucket, prefix=source_name + "/", recursive=False)
-
-        latest_backup = get_latest_backup(objects, source_name)
-        if latest_backup is None:
-            print(f"No backups found for source '{source_name}'.")
-            continue
-
-        print(f"\nLatest backup: {latest_backup.object_name}")
-
-        metadata = get_metadata_file(latest_backup, client, bucket)
-        if metadata is None:
-            print("No metadata found in the latest backup.")
-            continue
-        
-        print(f"Source type: {metadata.get('source_type', 'unknown')}")
-        print(f"Timestamp: {metadata.get('timestamp', 'unknown')}")
-        print(f"Total files: {len(metadata.get('entries', []))}")
-                
-        (retrieved, total) = retrieve_files(metadata, client, bucket)
-
-        print(f"\n=== Recovery completed for '{source_name}': Retrieved {retrieved}/{total} files ===")
+    # Reuses the backup's stat cache, so files untouched since the backup are
+    # recognised without being read
+    stat_cache_config = config.get("stat_cache", {})
+    if delta_restore and stat_cache_config.get("enabled", False):
+        stat_cache = StatCache(stat_cache_config.get("path", "./backup_state.db"))
+    
+    try:
+        if (source_filter or recover_all) and len(selected_sources) > 1:
+            # Sources named on the command line are independent of each other
+            max_sources = recovery_config.get("max_sources", 2)
+            with ThreadPoolExecutor(max_workers=max(1, max_sources)) as executor:
+                list(executor.map(lambda name: recover_source(client, bucket, name, max_workers), selected_sources))
+        else:
+            for source_name in selected_sources:
+                recover_source(client, bucket, source_name, max_workers)
+    finally:
+        if os.path.exists(temp_path_prefix):
+            shutil.rmtree(temp_path_prefix)
+        if stat_cache:
+            stat_cache.close()
+            stat_cache = None
+        if catalog:
+            catalog.close()
+            catalog = None
 
 if __name__ == "__main__":
-    source_filter = sys.argv[1] if len(sys.argv) > 1 else None
-    run_recovery(source_filter)
\ No newline at end of file
+    if len(sys.argv) > 3 and sys.argv[2] == "--target-time":
+        run_pitr(sys.argv[1], sys.argv[3])
+    elif sys.argv[1:] == ["--all"]:
+        run_recovery(recover_all=True)
+    else:
+        run_recovery(sys.argv[1:] or None)
\ No newline at end of file
@@ -0,0 +1,219 @@
+import os
+import json
+from datetime import datetime, timedelta, timezone
+from minio import Minio
+from minio.deleteobjects import DeleteObject
+
+from email_notifier import format_size
+from chunk_store import CHUNK_PREFIX, chunk_object_name
+from wal_archive import WAL_PREFIX, parse_wal_object_name
+from snapshot_index import INDEX_NAME, forget_snapshots
+from manifest import iter_entries, manifest_object_name
+from catalog import Catalog
+
+client = Minio(
+    "localhost:9000",
+    access_key="suispapp",
+    secret_key="suispappsecret",
+    secure=False
+)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+METADATA_NAME = "metadata.json"
+KEEP_RULES = ("keep_last", "keep_daily", "keep_weekly", "keep_monthly")
+# Calendar periods for the keep_* rules, each keeps the newest snapshot of its
+# N most recent periods
+PERIODS = {
+    "keep_daily": lambda moment: moment.strftime("%Y-%m-%d"),
+    "keep_weekly": lambda moment: "%d-W%02d" % moment.isocalendar()[:2],
+    "keep_monthly": lambda moment: moment.strftime("%Y-%m")
+}
+
+
+def load_config(path="config.json"):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def select_snapshots(timestamps, policy):
+    # A policy without any keep_* rule keeps everything
+    if not any(policy.get(rule, 0) for rule in KEEP_RULES):
+        return set(timestamps)
+    newest_first = sorted(timestamps, reverse=True)
+    keep = set(newest_first[:policy.get("keep_last", 0)])
+    for rule, period in PERIODS.items():
+        seen = set()
+        for timestamp in newest_first:
+            key = period(datetime.strptime(timestamp, TIMESTAMP_FORMAT))
+            if key in seen:
+                continue
+            if len(seen) >= policy.get(rule, 0):
+                break
+            seen.add(key)
+            keep.add(timestamp)
+    return keep
+
+
+def entry_objects(entry):
+    if entry.get("storage") == "chunks":
+        return [chunk_object_name(chunk_id) for chunk_id, _ in entry.get("chunks", [])]
+    if entry.get("format") in ("directory", "basebackup"):
+        return [file_entry["object_name"] for file_entry in entry.get("files", [])]
+    return [entry["object_name"]] if entry.get("object_name") else []
+
+
+def read_metadata(client, bucket, source_name, timestamp):
+    response = client.get_object(bucket, f"{source_name}/{timestamp}/{METADATA_NAME}")
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def scan_bucket(client, bucket):
+    # One recursive listing gives the size and age of every object and, per
+    # source, its snapshot prefixes and whether each one was completed
+    objects = {}
+    snapshots = {}
+    for obj in client.list_objects(bucket, recursive=True):
+        objects[obj.object_name] = (obj.size or 0, obj.last_modified)
+        parts = obj.object_name.split("/")
+        if parts[0] in (CHUNK_PREFIX, WAL_PREFIX) or len(parts) < 3:
+            continue
+        prefixes = snapshots.setdefault(parts[0], {})
+        prefixes[parts[1]] = prefixes.get(parts[1], False) or parts[2:] == [METADATA_NAME]
+    return objects, snapshots
+
+
+def plan_collection(client, bucket, retention_config, source_policies=None):
+    source_policies = source_policies or {}
+    grace = timedelta(hours=retention_config.get("grace_hours", 24))
+    objects, snapshots = scan_bucket(client, bucket)
+
+    live = set()
+    protected = []
+    forget = {}
+    wal_starts = {}
+    for source_name, prefixes in sorted(snapshots.items()):
+        completed = sorted(timestamp for timestamp, done in prefixes.items() if done)
+        # Unfinished prefixes newer than the last completed snapshot belong to
+        # a running or resumable backup; older ones are leftovers
+        newest = completed[-1] if completed else ""
+        protected += [f"{source_name}/{timestamp}/" for timestamp, done in prefixes.items() if not done and timestamp > newest]
+
+        keep = select_snapshots(completed, source_policies.get(source_name, retention_config))
+        keep |= {timestamp for timestamp in completed if datetime.strptime(timestamp, TIMESTAMP_FORMAT) > datetime.now() - grace}
+
+        # Mark: everything a kept manifest points at is live, including objects
+        # of older snapshots reused by skipped entries. An incremental database
+        # dump also keeps the snapshots of its chain back to the full dump.
+        pending = sorted(keep)
+        while pending:
+            timestamp = pending.pop()
+            metadata = read_metadata(client, bucket, source_name, timestamp)
+            live.add(f"{source_name}/{timestamp}/{METADATA_NAME}")
+            if "manifest" in metadata:
+                live.add(manifest_object_name(metadata))
+            for entry in iter_entries(client, bucket, metadata):
+                live.update(entry_objects(entry))
+                parent = entry.get("parent")
+                if parent and parent not in keep and prefixes.get(parent):
+                    keep.add(parent)
+                    pending.append(parent)
+                if entry.get("wal_start"):
+                    wal_starts[source_name] = min(wal_starts.get(source_name, entry["wal_start"]), entry["wal_start"])
+        live.add(f"{source_name}/{INDEX_NAME}")
+        forget[source_name] = sorted(set(completed) - keep)
+
+    cutoff = datetime.now(timezone.utc) - grace
+    garbage = []
+    for object_name, (size, modified) in objects.items():
+        if object_name in live or object_name.startswith(tuple(protected)):
+            continue
+        if modified is not None and modified > cutoff:
+            continue
+        parts = object_name.split("/")
+        if parts[0] == WAL_PREFIX:
+            # Segments are needed from the oldest kept base backup onwards;
+            # without a kept base backup nothing is known, so all are kept
+            file_name = parse_wal_object_name(object_name)[0]
+            wal_start = wal_starts.get(parts[1]) if len(parts) > 2 else None
+            if wal_start is None or file_name.endswith(".history") or file_name >= wal_start:
+                continue
+        elif len(parts) < 3:
+            continue
+        garbage.append((object_name, size))
+
+    # Metadata of forgotten snapshots goes first, so an interrupted sweep never
+    # leaves a snapshot that looks complete but has lost its data
+    garbage.sort(key=lambda item: (not item[0].endswith("/" + METADATA_NAME), item[0]))
+    return {
+        "forget": forget,
+        "garbage": garbage,
+        "reclaimable": sum(size for _, size in garbage),
+        "live": len(live)
+    }
+
+
+def remove_batched(client, bucket, object_names, batch_size=1000):
+    failed = []
+    for start in range(0, len(object_names), batch_size):
+        batch = [DeleteObject(name) for name in object_names[start:start + batch_size]]
+        # remove_objects is lazy, errors only surface while iterating
+        for error in client.remove_objects(bucket, batch):
+            print(f"  Failed to delete {error.name}: {error.message}")
+            failed.append(error.name)
+    return failed
+
+
+def run_retention(dry_run=True, config=None):
+    config = config or load_config()
+    bucket = config["bucket"]
+    retention_config = config.get("retention", {})
+    source_policies = {
+        source["name"]: dict(retention_config, **source["retention"])
+        for source in config.get("backup_sources", [])
+        if "retention" in source
+    }
+
+    plan = plan_collection(client, bucket, retention_config, source_policies)
+    print(f"\n=== Retention{' (dry run)' if dry_run else ''} ===")
+    for source_name, timestamps in plan["forget"].items():
+        print(f"{source_name}: {len(timestamps)} snapshot(s) to forget")
+        for timestamp in timestamps:
+            print(f"  - {timestamp}")
+    print(f"Live objects: {plan['live']}")
+    print(f"Unreferenced objects: {len(plan['garbage'])}, {format_size(plan['reclaimable'])} reclaimable")
+    if dry_run:
+        return plan
+
+    catalog = Catalog.from_config(config.get("catalog", {}))
+    try:
+        for source_name, timestamps in plan["forget"].items():
+            if not timestamps:
+                continue
+            forget_snapshots(client, bucket, source_name, timestamps)
+            if catalog:
+                for timestamp in timestamps:
+                    catalog.remove_snapshot(source_name, timestamp)
+    finally:
+        if catalog:
+            catalog.close()
+
+    failed = remove_batched(client, bucket, [name for name, _ in plan["garbage"]], retention_config.get("batch_size", 1000))
+    plan["failed"] = failed
+    print(f"Deleted {len(plan['garbage']) - len(failed)} object(s), {len(failed)} failed")
+    return plan
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] not in (["--dry-run"], ["--prune"]):
+        print("Usage:")
+        print("  Report what would be deleted: python retention.py --dry-run")
+        print("  Apply retention and delete:   python retention.py --prune")
+        sys.exit(1)
+
+    run_retention(dry_run=sys.argv[1] == "--dry-run", config=load_config(os.environ.get("BACKUP_CONFIG", "config.json")))
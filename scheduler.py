@@ -9,6 +9,7 @@ import json
 from datetime import datetime
 from backup import run_backup, load_config
 from email_notifier import send_email
+from retention import run_retention
 
 
 def scheduled_backup_job():
@@ -51,6 +52,13 @@ def scheduled_backup_job():
             send_email(config, backup_report)
         except Exception as e:
             print(f"Failed to send email notification: {e}")
+    
+    try:
+        config = load_config()
+        if config.get("retention", {}).get("enabled", False):
+            run_retention(dry_run=False, config=config)
+    except Exception as e:
+        print(f"Retention failed: {e}")
 
 
 def setup_schedule():
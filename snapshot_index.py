@@ -0,0 +1,86 @@
+import json
+from io import BytesIO
+
+INDEX_NAME = "index.json"
+SNAPSHOT_FIELDS = ["timestamp", "files_count", "total_size"]
+
+
+def index_object_name(source_name):
+    return f"{source_name}/{INDEX_NAME}"
+
+
+def read_index(client, bucket, source_name):
+    try:
+        response = client.get_object(bucket, index_object_name(source_name))
+    except Exception:
+        return None
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    except ValueError as e:
+        print(f"Ignoring unreadable snapshot index for {source_name}: {e}")
+        return None
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def write_index(client, bucket, source_name, index):
+    # A single PUT replaces the object atomically, readers see the old or the new index
+    data = json.dumps(index, separators=(",", ":")).encode("utf-8")
+    client.put_object(bucket, index_object_name(source_name), data=BytesIO(data), length=len(data))
+
+
+def list_snapshot_timestamps(client, bucket, source_name):
+    timestamps = set()
+    for obj in client.list_objects(bucket, prefix=f"{source_name}/", recursive=False):
+        if not obj.is_dir:
+            continue
+        timestamp = obj.object_name.rstrip('/').split('/')[-1]
+        if timestamp:
+            timestamps.add(timestamp)
+    return sorted(timestamps)
+
+
+def rebuild_index(client, bucket, source_name):
+    # Only used when the index object is missing; sizes and counts of older
+    # snapshots are unknown at this point and left empty
+    snapshots = []
+    for timestamp in list_snapshot_timestamps(client, bucket, source_name):
+        try:
+            client.stat_object(bucket, f"{source_name}/{timestamp}/metadata.json")
+        except Exception:
+            continue
+        snapshots.append([timestamp, None, None])
+    return {
+        "source_name": source_name,
+        "latest": snapshots[-1][0] if snapshots else None,
+        "snapshot_fields": SNAPSHOT_FIELDS,
+        "snapshots": snapshots
+    }
+
+
+def record_snapshot(client, bucket, source_name, timestamp, files_count, total_size):
+    index = read_index(client, bucket, source_name) or rebuild_index(client, bucket, source_name)
+    snapshots = [row for row in index.get("snapshots", []) if row[0] != timestamp]
+    snapshots.append([timestamp, files_count, total_size])
+    snapshots.sort(key=lambda row: row[0])
+    index["snapshots"] = snapshots
+    index["snapshot_fields"] = SNAPSHOT_FIELDS
+    index["latest"] = snapshots[-1][0]
+    write_index(client, bucket, source_name, index)
+    return index
+
+
+def snapshot_timestamps(index):
+    return [row[0] for row in index.get("snapshots", [])]
+
+
+def forget_snapshots(client, bucket, source_name, timestamps):
+    index = read_index(client, bucket, source_name)
+    if index is None:
+        return None
+    removed = set(timestamps)
+    index["snapshots"] = [row for row in index.get("snapshots", []) if row[0] not in removed]
+    index["latest"] = index["snapshots"][-1][0] if index["snapshots"] else None
+    write_index(client, bucket, source_name, index)
+    return index
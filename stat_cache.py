@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Files modified this recently may still change within the same mtime tick,
+# so their hashes are not cached (the "racy" case)
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+class StatCache:
+    
+    def __init__(self, db_path="./backup_state.db"):
+        self.db_path = db_path
+        self.trusted = True
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_state (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                ctime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_info (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+    
+    def begin_run(self, paranoid_every=0):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cache_info WHERE key = 'run_count'").fetchone()
+            run_count = (row[0] if row else 0) + 1
+            self._conn.execute("INSERT OR REPLACE INTO cache_info (key, value) VALUES ('run_count', ?)", (run_count,))
+            self._conn.commit()
+        # Every Nth run ignores cached hashes so silent corruption still gets caught
+        self.trusted = not (paranoid_every and run_count % paranoid_every == 0)
+        if not self.trusted:
+            print(f"Stat cache: paranoid run {run_count}, rehashing all files")
+        return run_count
+    
+    def _key(self, path):
+        return os.path.abspath(str(path))
+    
+    def _stat_tuple(self, st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+    
+    def lookup(self, path, st):
+        if not self.trusted:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, ctime_ns, sha256 FROM file_state WHERE path = ?",
+                (self._key(path),)
+            ).fetchone()
+        if row and tuple(row[:4]) == self._stat_tuple(st):
+            return row[4]
+        return None
+    
+    def store(self, path, st, sha256):
+        if time.time_ns() - st.st_mtime_ns < RACY_WINDOW_NS:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_state (path, size, mtime_ns, inode, ctime_ns, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(path), *self._stat_tuple(st), sha256)
+            )
+            self._pending += 1
+            if self._pending >= 1000:
+                self._conn.commit()
+                self._pending = 0
+    
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+    
+    def close(self):
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from minio import Minio
+from encryption import EncryptionManager
+from compression import DEFAULT_LEVELS, compress_bytes, decompress_bytes
+
+# Segments live outside the per-source snapshot prefixes, one folder per source
+WAL_PREFIX = "wal"
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
+
+def wal_object_prefix(source_name):
+    return f"{WAL_PREFIX}/{source_name}/"
+
+
+def wal_object_name(source_name, file_name, codec=None, encrypted=False):
+    object_name = wal_object_prefix(source_name) + file_name
+    if codec:
+        object_name += "." + codec
+    if encrypted:
+        object_name += ".enc"
+    return object_name
+
+
+def parse_wal_object_name(object_name):
+    # History files (00000002.history) have a dot of their own, so only the
+    # suffixes added by wal_object_name are stripped
+    name = object_name.rsplit("/", 1)[-1]
+    encrypted = name.endswith(".enc")
+    if encrypted:
+        name = name[:-len(".enc")]
+    codec = None
+    base, _, suffix = name.rpartition(".")
+    if base and suffix in DEFAULT_LEVELS:
+        name, codec = base, suffix
+    return name, codec, encrypted
+
+
+def encode_segment(data, encryption_manager=None, codec=None, level=None):
+    if codec:
+        data = compress_bytes(data, codec, level)
+    if encryption_manager:
+        data = encryption_manager.encrypt_data(data)
+    return data
+
+
+def decode_segment(data, object_name, encryption_manager=None):
+    _, codec, encrypted = parse_wal_object_name(object_name)
+    if encrypted:
+        if not encryption_manager:
+            raise Exception(f"{object_name} is encrypted but no encryption key is available")
+        data = encryption_manager.decrypt_data(data)
+    if codec:
+        data = decompress_bytes(data, codec)
+    return data
+
+
+def list_segments(client, bucket, source_name):
+    segments = {}
+    for obj in client.list_objects(bucket, prefix=wal_object_prefix(source_name), recursive=True):
+        file_name, _, _ = parse_wal_object_name(obj.object_name)
+        segments[file_name] = obj.object_name
+    return segments
+
+
+def find_segment(client, bucket, source_name, file_name):
+    for obj in client.list_objects(bucket, prefix=wal_object_prefix(source_name) + file_name, recursive=True):
+        if parse_wal_object_name(obj.object_name)[0] == file_name:
+            return obj.object_name
+    return None
+
+
+def read_segment(client, bucket, object_name, encryption_manager=None):
+    response = client.get_object(bucket, object_name)
+    try:
+        data = response.read()
+    finally:
+        response.close()
+        response.release_conn()
+    return decode_segment(data, object_name, encryption_manager)
+
+
+def push_segment(client, bucket, source_name, path, file_name, encryption_manager=None, codec=None, level=None):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    # archive_command may be retried for a segment that already made it, which
+    # is fine as long as the archived copy is identical
+    existing = find_segment(client, bucket, source_name, file_name)
+    if existing:
+        archived = read_segment(client, bucket, existing, encryption_manager)
+        if hashlib.sha256(archived).digest() != hashlib.sha256(data).digest():
+            raise Exception(f"{existing} already exists with different contents")
+        print(f"Already archived: {file_name}")
+        return existing
+
+    object_name = wal_object_name(source_name, file_name, codec, encryption_manager is not None)
+    payload = encode_segment(data, encryption_manager, codec, level)
+    client.put_object(bucket, object_name, data=BytesIO(payload), length=len(payload))
+    print(f"Archived: {file_name} -> {object_name}")
+    return object_name
+
+
+def fetch_segment(client, bucket, object_name, dest_path, encryption_manager=None):
+    data = read_segment(client, bucket, object_name, encryption_manager)
+    # PostgreSQL must never see a partially written segment
+    temp_path = f"{dest_path}.part"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, dest_path)
+    return dest_path
+
+
+def prefetch_segments(client, bucket, source_name, dest_dir, start, end=None, encryption_manager=None, workers=8):
+    # Downloads every segment from start up to and including end (all later
+    # ones when end is None) plus timeline history files, in parallel, so
+    # replay only has to copy local files
+    os.makedirs(dest_dir, exist_ok=True)
+    wanted = [
+        (file_name, object_name)
+        for file_name, object_name in sorted(list_segments(client, bucket, source_name).items())
+        if file_name.endswith(".history")
+        or (len(file_name) == 24 and file_name >= start and (end is None or file_name <= end))
+    ]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(
+            lambda item: fetch_segment(client, bucket, item[1], os.path.join(dest_dir, item[0]), encryption_manager),
+            wanted
+        ))
+    return len(wanted)
+
+
+def load_archive_settings(config_path=CONFIG_PATH):
+    with open(config_path, "r") as f:
+        config = json.load(f)
+
+    encryption_manager = None
+    encryption_config = config.get("encryption", {})
+    if encryption_config.get("enabled", False):
+        # PostgreSQL runs archive_command and restore_command from the data
+        # directory, so the key is found next to the config file. A missing key
+        # is an error: generating one would encrypt WAL nobody can decrypt.
+        key_file = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(config_path)), encryption_config.get("key_file", "./encryption.key")))
+        if not os.path.exists(key_file):
+            raise Exception(f"encryption key {key_file} not found")
+        encryption_manager = EncryptionManager(key_file=key_file)
+
+    compression_config = config.get("compression", {})
+    codec = compression_config.get("codec", "zlib") if compression_config.get("enabled", False) else None
+    return config["bucket"], encryption_manager, codec, compression_config.get("level")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 5:
+        print("Usage:")
+        print("  archive_command: python wal_archive.py push <source_name> %p %f")
+        print("  restore_command: python wal_archive.py fetch <source_name> %f %p")
+        sys.exit(1)
+
+    command, source_name = sys.argv[1], sys.argv[2]
+    client = Minio(
+        "localhost:9000",
+        access_key="suispapp",
+        secret_key="suispappsecret",
+        secure=False
+    )
+    try:
+        bucket, encryption_manager, codec, level = load_archive_settings(os.environ.get("BACKUP_CONFIG", CONFIG_PATH))
+        if command == "push":
+            push_segment(client, bucket, source_name, sys.argv[3], sys.argv[4], encryption_manager, codec, level)
+        elif command == "fetch":
+            object_name = find_segment(client, bucket, source_name, sys.argv[3])
+            if not object_name:
+                # A missing segment is how PostgreSQL learns it reached the end of the archive
+                sys.exit(1)
+            fetch_segment(client, bucket, object_name, sys.argv[4], encryption_manager)
+        else:
+            print(f"Unknown command: {command}")
+            sys.exit(1)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)